@@ -9,15 +9,31 @@ Stack: Streamlit + Google Sheets (gspread) + Plotly
 
 import streamlit as st
 import pandas as pd
+import numpy as np
 import plotly.express as px
 import plotly.graph_objects as go
+import pyarrow as pa
+import pyarrow.parquet as pq
 import gspread
+from openpyxl import Workbook, load_workbook
 from google.oauth2.service_account import Credentials
-from datetime import datetime, date
+from google.auth.exceptions import GoogleAuthError
+import requests
+from datetime import datetime, date, timedelta
+from contextlib import contextmanager
+from collections import Counter, OrderedDict
 import hashlib
+import itertools
 import json
-import io
+import os
+import random
+import re
+import shutil
+import sqlite3
+import tempfile
+import threading
 import time
+import unicodedata
 
 # ============================================================
 # CONFIGURACIÓN GENERAL
@@ -246,89 +262,952 @@ COLUMNAS_DATOS = [
     "ultima_modificacion_por", "ultima_modificacion_fecha"
 ]
 
+# Tipo de cada columna de DATOS, aplicado una sola vez al cargar la hoja.
+# Las columnas no listadas quedan como texto.
+TIPOS_COLUMNAS = {
+    "fecha_digitacion": "fecha_hora",
+    "ultima_modificacion_fecha": "fecha_hora",
+    "fecha_notificacion_sivigila": "fecha",
+    "fecha_atencion_medicina": "fecha",
+    "fecha_alta": "fecha",
+    "fecha_psicologia": "fecha",
+    "fecha_psiquiatria": "fecha",
+    "fecha_seguimiento_postalta": "fecha",
+    "edad": "entero",
+    "semana_epidemiologica": "entero",
+    "num_seguimientos_realizados": "entero",
+    "funcionario_reporta": "categoria",
+    "eps_reporta": "categoria",
+    "ciclo_vital": "categoria",
+    "intento_previo": "categoria",
+    "tipo_documento": "categoria",
+    "sexo": "categoria",
+    "municipio_residencia": "categoria",
+    "hospitalizacion": "categoria",
+    "valoracion_psicologia": "categoria",
+    "valoracion_psiquiatria": "categoria",
+    "ruta_salud_mental": "categoria",
+    "asiste_servicios": "categoria",
+    "seguimiento_7dias_postalta": "categoria",
+    "abandono_tratamiento": "categoria",
+    "reintento_posterior": "categoria",
+    "estado_caso": "categoria",
+    "gp_discapacidad": "categoria",
+    "gp_desplazado": "categoria",
+    "gp_migrante": "categoria",
+    "gp_gestante": "categoria",
+    "gp_desmovilizado": "categoria",
+    "gp_indigena": "categoria",
+    "ultima_modificacion_por": "categoria",
+}
+ESQUEMA_DATOS = {col: TIPOS_COLUMNAS.get(col, "texto") for col in COLUMNAS_DATOS}
+
+# ============================================================
+# PLANIFICADOR DE LLAMADAS A LA API DE GOOGLE SHEETS
+# ============================================================
+
+# Cuotas por minuto de la API de Sheets para la cuenta de servicio
+CUOTA_LECTURAS_MINUTO = 60
+CUOTA_ESCRITURAS_MINUTO = 60
+RESERVA_INTERACTIVA = 10  # fichas que las cargas masivas no pueden consumir
+MAX_REINTENTOS_API = 5
+BACKOFF_BASE = 1.0  # segundos
+BACKOFF_MAXIMO = 64.0  # segundos
+CODIGOS_REINTENTABLES = {429, 500, 502, 503, 504}
+
+
+@st.cache_resource(show_spinner=False)
+def _planificador_api():
+    """
+    Estado del planificador, compartido por todo el proceso: un token bucket
+    por tipo de cuota (lectura/escritura) y la cantidad de llamadas en espera
+    por prioridad (interactiva/masiva).
+    """
+    ahora = time.monotonic()
+    cubetas = {}
+    for tipo, cuota in (("lectura", CUOTA_LECTURAS_MINUTO), ("escritura", CUOTA_ESCRITURAS_MINUTO)):
+        cubetas[tipo] = {
+            "capacidad": cuota,
+            "fichas": float(cuota),
+            "ritmo": cuota / 60.0,  # fichas por segundo
+            "actualizado": ahora,
+            "en_espera": {"interactiva": 0, "masiva": 0},
+        }
+    return {"condicion": threading.Condition(), "cubetas": cubetas, "reintentos": 0}
+
+
+def _recargar_cubeta(cubeta):
+    """Suma las fichas acumuladas desde la última consulta (sin exceder la capacidad)."""
+    ahora = time.monotonic()
+    cubeta["fichas"] = min(cubeta["capacidad"],
+                           cubeta["fichas"] + (ahora - cubeta["actualizado"]) * cubeta["ritmo"])
+    cubeta["actualizado"] = ahora
+
+
+def _tomar_ficha(tipo, prioridad):
+    """
+    Bloquea hasta obtener una ficha del bucket `tipo`. Las llamadas masivas
+    dejan RESERVA_INTERACTIVA fichas libres y ceden el turno mientras haya
+    llamadas interactivas esperando.
+    """
+    plan = _planificador_api()
+    cubeta = plan["cubetas"][tipo]
+    necesarias = 1 + (RESERVA_INTERACTIVA if prioridad == "masiva" else 0)
+    with plan["condicion"]:
+        cubeta["en_espera"][prioridad] += 1
+        try:
+            while True:
+                _recargar_cubeta(cubeta)
+                cede = prioridad == "masiva" and cubeta["en_espera"]["interactiva"] > 0
+                if cubeta["fichas"] >= necesarias and not cede:
+                    cubeta["fichas"] -= 1
+                    return
+                faltante = max(necesarias - cubeta["fichas"], 0.1)
+                plan["condicion"].wait(timeout=faltante / cubeta["ritmo"])
+        finally:
+            cubeta["en_espera"][prioridad] -= 1
+            plan["condicion"].notify_all()
+
+
+def _es_reintentable(error):
+    """429 (cuota), 5xx y fallas de red se reintentan; el resto se propaga."""
+    if isinstance(error, gspread.exceptions.APIError):
+        return error.response.status_code in CODIGOS_REINTENTABLES
+    return isinstance(error, (requests.exceptions.ConnectionError, requests.exceptions.Timeout))
+
+
+def _es_cuota(error):
+    """429: la API rechazó la llamada sin aplicarla."""
+    return isinstance(error, gspread.exceptions.APIError) and error.response.status_code == 429
+
+
+def _pausa_reintento(intento):
+    """Backoff exponencial con jitter completo."""
+    time.sleep(random.uniform(0, min(BACKOFF_MAXIMO, BACKOFF_BASE * 2 ** intento)))
+
+
+def llamar_api(tipo, funcion, *args, prioridad="interactiva", idempotente=True, **kwargs):
+    """
+    Ejecuta una llamada de gspread a través del planificador central.
+    tipo: "lectura" o "escritura" (cuota que consume).
+    prioridad: "interactiva" (usuarios) o "masiva" (cargas masivas).
+    Reintenta 429/5xx y errores de red con backoff exponencial y jitter completo.
+    Con idempotente=False (p. ej. append) solo reintenta 429: tras un 5xx o una
+    falla de red la llamada pudo haberse aplicado.
+    """
+    plan = _planificador_api()
+    for intento in range(MAX_REINTENTOS_API + 1):
+        _tomar_ficha(tipo, prioridad)
+        try:
+            return funcion(*args, **kwargs)
+        except Exception as e:
+            reintentable = _es_reintentable(e) if idempotente else _es_cuota(e)
+            if intento == MAX_REINTENTOS_API or not reintentable:
+                raise
+            with plan["condicion"]:
+                plan["reintentos"] += 1
+                if _es_cuota(e):
+                    # La cuota real se agotó (puede compartirse con otros procesos): vaciar el bucket
+                    plan["cubetas"][tipo]["fichas"] = 0.0
+            _pausa_reintento(intento)
+
+
+def estado_planificador():
+    """Fichas disponibles y llamadas en espera por tipo de cuota y prioridad."""
+    plan = _planificador_api()
+    with plan["condicion"]:
+        estado = {}
+        for tipo, cubeta in plan["cubetas"].items():
+            _recargar_cubeta(cubeta)
+            estado[tipo] = {"fichas": int(cubeta["fichas"]), **cubeta["en_espera"]}
+        estado["reintentos"] = plan["reintentos"]
+        return estado
+
+
 # ============================================================
 # FUNCIONES DE CONEXIÓN A GOOGLE SHEETS
 # ============================================================
 
+SCOPES_GSHEETS = [
+    "https://www.googleapis.com/auth/spreadsheets",
+    "https://www.googleapis.com/auth/drive"
+]
+
+
+@st.cache_resource(show_spinner=False)
+def _conexion_gsheets(spreadsheet_id):
+    """
+    Autoriza el cliente y abre el spreadsheet una sola vez por proceso.
+    La sesión HTTP del cliente reutiliza conexiones y renueva el token
+    de la cuenta de servicio automáticamente al vencer.
+    """
+    creds_dict = dict(st.secrets["gcp_service_account"])
+    creds = Credentials.from_service_account_info(creds_dict, scopes=SCOPES_GSHEETS)
+    client = gspread.authorize(creds)
+    return llamar_api("lectura", client.open_by_key, spreadsheet_id)
+
+
+@st.cache_resource(show_spinner=False)
+def _hojas_gsheets():
+    """Handles de hojas ya abiertas, por (spreadsheet_id, título)."""
+    return {"lock": threading.Lock(), "hojas": {}}
+
+
 def obtener_conexion_gsheets():
     """
     Conecta a Google Sheets usando las credenciales de la cuenta de servicio
-    almacenadas en st.secrets.
+    almacenadas en st.secrets. La conexión se reutiliza entre reruns y sesiones.
     Retorna el objeto spreadsheet.
     """
     try:
-        scopes = [
-            "https://www.googleapis.com/auth/spreadsheets",
-            "https://www.googleapis.com/auth/drive"
-        ]
-        creds_dict = dict(st.secrets["gcp_service_account"])
-        creds = Credentials.from_service_account_info(creds_dict, scopes=scopes)
-        client = gspread.authorize(creds)
-        spreadsheet = client.open_by_key(st.secrets["spreadsheet_id"])
-        return spreadsheet
+        return _conexion_gsheets(st.secrets["spreadsheet_id"])
     except Exception as e:
         st.error(f"❌ Error al conectar con Google Sheets: {str(e)}")
         st.info("Verifique que las credenciales en st.secrets estén correctamente configuradas.")
         return None
 
 
+def reiniciar_conexion_gsheets():
+    """Descarta el cliente y los handles cacheados; la siguiente llamada reconecta."""
+    _conexion_gsheets.clear()
+    _hojas_gsheets.clear()
+
+
+def reconectar_si_corresponde(error):
+    """Ante errores de red o de autenticación descarta la conexión cacheada."""
+    if isinstance(error, gspread.exceptions.APIError):
+        if error.response.status_code not in (401, 403):
+            return
+    elif not isinstance(error, (requests.exceptions.RequestException, GoogleAuthError)):
+        return
+    reiniciar_conexion_gsheets()
+
+
+def _obtener_hoja(spreadsheet, titulo, crear):
+    """Retorna el handle cacheado de la hoja; si no existe la crea con crear(spreadsheet)."""
+    cache = _hojas_gsheets()
+    clave = (spreadsheet.id, titulo)
+    hoja = cache["hojas"].get(clave)
+    if hoja is None:
+        try:
+            hoja = llamar_api("lectura", spreadsheet.worksheet, titulo)
+        except gspread.exceptions.WorksheetNotFound:
+            hoja = crear(spreadsheet)
+        with cache["lock"]:
+            cache["hojas"][clave] = hoja
+    return hoja
+
+
+def _crear_hoja_datos(spreadsheet):
+    """Crea la hoja DATOS con los encabezados."""
+    hoja = llamar_api("escritura", spreadsheet.add_worksheet,
+                      title="DATOS", rows=1000, cols=len(COLUMNAS_DATOS))
+    llamar_api("escritura", hoja.append_row, COLUMNAS_DATOS, idempotente=False)
+    return hoja
+
+
+def _crear_hoja_usuarios(spreadsheet):
+    """Crea la hoja USUARIOS con los encabezados."""
+    hoja = llamar_api("escritura", spreadsheet.add_worksheet, title="USUARIOS", rows=100, cols=5)
+    llamar_api("escritura", hoja.append_row, COLUMNAS_USUARIOS, idempotente=False)
+    return hoja
+
+
 def obtener_hoja_datos(spreadsheet):
-    """Retorna la hoja 'DATOS' del spreadsheet."""
-    try:
-        return spreadsheet.worksheet("DATOS")
-    except gspread.exceptions.WorksheetNotFound:
-        # Crear la hoja si no existe, con los encabezados
-        hoja = spreadsheet.add_worksheet(title="DATOS", rows=1000, cols=len(COLUMNAS_DATOS))
-        hoja.append_row(COLUMNAS_DATOS)
-        return hoja
+    """Retorna la hoja 'DATOS' del spreadsheet (la crea si no existe)."""
+    return _obtener_hoja(spreadsheet, "DATOS", _crear_hoja_datos)
 
 
 def obtener_hoja_usuarios(spreadsheet):
-    """Retorna la hoja 'USUARIOS' del spreadsheet."""
+    """Retorna la hoja 'USUARIOS' del spreadsheet (la crea si no existe)."""
+    return _obtener_hoja(spreadsheet, "USUARIOS", _crear_hoja_usuarios)
+
+
+# ============================================================
+# ALMACENAMIENTO (Google Sheets o SQLite)
+# ============================================================
+# Todo acceso a DATOS y USUARIOS pasa por un objeto "almacén" con esta interfaz:
+#   clave                                → identifica al almacén en las cachés del proceso
+#   descargar_datos()                    → (DataFrame de texto, extra) con todo DATOS
+#   leer_cambios(entrada)                → (DataFrame de texto, posiciones leídas, extra)
+#                                          con lo nuevo o modificado, o None si hace falta
+#                                          una descarga completa
+#   agregar_filas(filas, prioridad)      → posiciones asignadas a las filas nuevas
+#   leer_fila(id, posicion)              → (posición, fila vigente), o None si el id no existe
+#   escribir_celdas(posicion, cambios, version)
+#                                        → escribe solo {columna: valor}; False si el almacén
+#                                          detecta que la versión del registro ya cambió
+#   leer_usuarios() / agregar_usuario(fila)
+# La "posición" de un registro es el índice del DataFrame de DATOS.
+
+MAX_RANGOS_DELTA = 50  # con más rangos modificados conviene una descarga completa
+
+
+def _filas_a_dataframe(filas, indices):
+    """
+    Arma el DataFrame de DATOS a partir de filas crudas de la hoja.
+    El índice conserva la posición en la hoja: fila de la hoja = índice + 2.
+    """
+    if not filas:
+        return pd.DataFrame(columns=COLUMNAS_DATOS)
+    num_cols = len(COLUMNAS_DATOS)
+    # Forzar encabezados definidos (ignorar lo que diga la hoja)
+    # Rellenar filas cortas con cadenas vacías
+    datos = [(row + [''] * num_cols)[:num_cols] for row in filas]
+    df = pd.DataFrame(datos, columns=COLUMNAS_DATOS, index=pd.Index(indices))
+    # Eliminar filas completamente vacías
+    no_vacias = df.apply(lambda col: col.str.strip() != "").any(axis=1)
+    return df[no_vacias]
+
+
+def _agrupar_rangos(posiciones):
+    """Agrupa posiciones ordenadas en rangos contiguos [(inicio, fin), ...]."""
+    rangos = []
+    for p in posiciones:
+        if rangos and p == rangos[-1][1] + 1:
+            rangos[-1][1] = p
+        else:
+            rangos.append([p, p])
+    return rangos
+
+
+def fila_inicial_anexada(respuesta):
+    """Primera fila escrita por append_row(s), leída de updates.updatedRange."""
+    try:
+        rango = respuesta["updates"]["updatedRange"]
+        return int(re.search(r"!\$?[A-Z]+\$?(\d+)", rango).group(1))
+    except (KeyError, TypeError, AttributeError):
+        return None
+
+
+class AlmacenGoogleSheets:
+    """Almacén sobre el spreadsheet de Google (hojas DATOS y USUARIOS)."""
+
+    def __init__(self, spreadsheet):
+        self.spreadsheet = spreadsheet
+        self.clave = spreadsheet.id
+
+    def descargar_datos(self):
+        hoja = obtener_hoja_datos(self.spreadsheet)
+        all_values = llamar_api("lectura", hoja.get_all_values)
+        filas = all_values[1:]
+        return _filas_a_dataframe(filas, range(len(filas))), {"filas": len(filas)}
+
+    def leer_cambios(self, entrada):
+        """
+        Lee solo las columnas id y ultima_modificacion_fecha y descarga las filas
+        agregadas o cuya fecha de modificación difiere de la cacheada (sin marca
+        de agua). Pide descarga
+        completa si hay filas borradas o movidas, o demasiados cambios dispersos.
+        """
+        hoja = obtener_hoja_datos(self.spreadsheet)
+        df = entrada["df"]
+        ult_col = col_num_a_letra(len(COLUMNAS_DATOS))
+        col_ids, col_mod = llamar_api("lectura", hoja.batch_get, ["A2:A", f"{ult_col}2:{ult_col}"])
+        ids = [f[0] if f else "" for f in col_ids]
+        mods = [f[0] if f else "" for f in col_mod]
+        total = max(len(ids), len(mods))
+        conocidas = entrada["filas"]
+        if total < conocidas:
+            return None
+        ids += [""] * (total - len(ids))
+        mods += [""] * (total - len(mods))
+
+        # Integridad: los ids ya cacheados deben seguir en la misma fila
+        ids_hoja = pd.Series(ids, dtype=object).reindex(df.index)
+        if not (ids_hoja == df["id"].astype(object)).all():
+            return None
+
+        # Las filas nuevas ya reflejadas por write-through tampoco se descargan
+        fechas = _parsear_fechas(pd.Series(mods, dtype=object))
+        modificadas = (_fechas_distintas(fechas, df["ultima_modificacion_fecha"])
+                       | ((fechas.index >= conocidas) & ~fechas.index.isin(df.index)))
+        posiciones = modificadas[modificadas].index.tolist()
+        if not posiciones:
+            return _filas_a_dataframe([], []), [], {"filas": total}
+
+        rangos = _agrupar_rangos(posiciones)
+        if len(rangos) > MAX_RANGOS_DELTA:
+            return None
+        bloques = llamar_api("lectura", hoja.batch_get,
+                             [f"A{a + 2}:{ult_col}{b + 2}" for a, b in rangos])
+        filas, indices = [], []
+        for (a, b), bloque in zip(rangos, bloques):
+            bloque = list(bloque) + [[]] * (b - a + 1 - len(bloque))
+            filas.extend(list(f) for f in bloque)
+            indices.extend(range(a, b + 1))
+        return _filas_a_dataframe(filas, indices), indices, {"filas": total}
+
+    def agregar_filas(self, filas, prioridad="interactiva"):
+        """
+        Append no idempotente: tras un 5xx o una falla de red se buscan en la
+        columna A los IDs del lote y se reintentan solo las filas que no quedaron.
+        Si parte del lote ya estaba escrito, las posiciones no se conocen (None).
+        """
+        hoja = obtener_hoja_datos(self.spreadsheet)
+        pendientes = filas
+        for intento in range(MAX_REINTENTOS_API + 1):
+            try:
+                respuesta = llamar_api("escritura", hoja.append_rows, pendientes, prioridad=prioridad,
+                                       idempotente=False, value_input_option="USER_ENTERED",
+                                       table_range="A1")
+                break
+            except Exception as e:
+                if intento == MAX_REINTENTOS_API or not _es_reintentable(e):
+                    raise
+                _pausa_reintento(intento)
+                escritos = {v.strip() for v in llamar_api("lectura", hoja.col_values, 1,
+                                                          prioridad=prioridad)}
+                pendientes = [f for f in pendientes if str(f[0]).strip() not in escritos]
+                if not pendientes:
+                    return None
+        primera = fila_inicial_anexada(respuesta)
+        if primera is None or len(pendientes) != len(filas):
+            return None
+        return [primera - 2 + n for n in range(len(filas))]
+
+    def leer_fila(self, id_registro, posicion):
+        hoja = obtener_hoja_datos(self.spreadsheet)
+        id_registro = str(id_registro).strip()
+        ult_col = col_num_a_letra(len(COLUMNAS_DATOS))
+        num_cols = len(COLUMNAS_DATOS)
+        # Confirmar la posición del índice leyendo esa fila
+        if posicion is not None:
+            valores = llamar_api("lectura", hoja.get, f"A{posicion + 2}:{ult_col}{posicion + 2}")
+            fila = list(valores[0]) if valores else []
+            if fila and fila[0].strip() == id_registro:
+                return posicion, (fila + [""] * num_cols)[:num_cols]
+
+        # Índice desactualizado: buscar en la columna A
+        celdas_col_a = llamar_api("lectura", hoja.col_values, 1)  # Columna A = id
+        for i, valor in enumerate(celdas_col_a):
+            if valor.strip() == id_registro:
+                fila_num = i + 1  # gspread es 1-indexado
+                valores = llamar_api("lectura", hoja.get, f"A{fila_num}:{ult_col}{fila_num}")
+                fila = list(valores[0]) if valores else []
+                return fila_num - 2, (fila + [""] * num_cols)[:num_cols]
+        return None
+
+    def escribir_celdas(self, posicion, cambios, version):
+        # Sheets no tiene escrituras condicionales: la versión se verificó al leer la fila
+        hoja = obtener_hoja_datos(self.spreadsheet)
+        datos = [{"range": f"{col_num_a_letra(COLUMNAS_DATOS.index(col) + 1)}{posicion + 2}",
+                  "values": [[valor]]}
+                 for col, valor in cambios.items()]
+        llamar_api("escritura", hoja.batch_update, datos, value_input_option="USER_ENTERED")
+        return True
+
+    def leer_usuarios(self):
+        hoja = obtener_hoja_usuarios(self.spreadsheet)
+        return llamar_api("lectura", hoja.get_all_records)
+
+    def agregar_usuario(self, fila):
+        hoja = obtener_hoja_usuarios(self.spreadsheet)
+        llamar_api("escritura", hoja.append_row, fila, idempotente=False)
+
+
+COLUMNAS_USUARIOS = ["usuario", "password_hash", "nombre_completo", "rol", "eps_asignada"]
+COLUMNAS_INDEXADAS_SQLITE = ["id", "numero_documento", "eps_reporta",
+                             "fecha_notificacion_sivigila", "ultima_modificacion_fecha"]
+MAX_PARAMETROS_SQLITE = 900  # por consulta (el límite de SQLite antiguo es 999)
+_INSERTAR_DATOS_SQLITE = ("INSERT INTO datos (" + ", ".join(f'"{c}"' for c in COLUMNAS_DATOS) + ") "
+                          f"VALUES ({', '.join('?' * len(COLUMNAS_DATOS))})")
+_INSERTAR_USUARIO_SQLITE = f"INSERT INTO usuarios VALUES ({', '.join('?' * len(COLUMNAS_USUARIOS))})"
+_CON_DATOS_SQLITE = "SELECT EXISTS (SELECT 1 FROM datos) OR EXISTS (SELECT 1 FROM usuarios)"
+
+
+@st.cache_resource(show_spinner=False)
+def _preparar_sqlite(ruta):
+    """Crea tablas e índices de la base SQLite (una vez por proceso)."""
+    con = sqlite3.connect(ruta)
+    try:
+        with con:
+            con.execute("PRAGMA journal_mode=WAL")
+            columnas = ", ".join(f'"{c}" TEXT NOT NULL DEFAULT \'\'' for c in COLUMNAS_DATOS)
+            tabla = f"(posicion INTEGER PRIMARY KEY AUTOINCREMENT, {columnas})"
+            con.execute(f"CREATE TABLE IF NOT EXISTS datos {tabla}")
+            # Bases creadas sin la columna posicion: se copian conservando el rowid
+            if "posicion" not in [c[1] for c in con.execute("PRAGMA table_info(datos)")]:
+                nombres = ", ".join(f'"{c}"' for c in COLUMNAS_DATOS)
+                con.execute(f"CREATE TABLE datos_posicion {tabla}")
+                con.execute(f"INSERT INTO datos_posicion (posicion, {nombres}) "
+                            f"SELECT rowid, {nombres} FROM datos ORDER BY rowid")
+                con.execute("DROP TABLE datos")
+                con.execute("ALTER TABLE datos_posicion RENAME TO datos")
+            for col in COLUMNAS_INDEXADAS_SQLITE:
+                con.execute(f'CREATE INDEX IF NOT EXISTS idx_datos_{col} ON datos ("{col}")')
+            columnas = ", ".join(f'"{c}" TEXT NOT NULL DEFAULT \'\'' for c in COLUMNAS_USUARIOS)
+            con.execute(f"CREATE TABLE IF NOT EXISTS usuarios ({columnas})")
+    finally:
+        con.close()
+    return True
+
+
+class AlmacenSQLite:
+    """
+    Almacén local en un archivo SQLite, con el mismo esquema de texto que la
+    hoja DATOS. La posición de cada registro es la columna posicion (INTEGER
+    PRIMARY KEY AUTOINCREMENT): VACUUM no la renumera y no se reutiliza tras
+    borrar el último registro.
+    """
+
+    def __init__(self, ruta):
+        self.ruta = ruta
+        self.clave = f"sqlite:{os.path.abspath(ruta)}"
+        _preparar_sqlite(ruta)
+
+    @contextmanager
+    def _conexion(self):
+        con = sqlite3.connect(self.ruta, timeout=30)
+        try:
+            with con:
+                yield con
+        finally:
+            con.close()
+
+    def _consultar_datos(self, con, condicion="", parametros=()):
+        df = pd.read_sql_query(f"SELECT * FROM datos {condicion} ORDER BY posicion",
+                               con, params=parametros, index_col="posicion")
+        df.index.name = None
+        return df.reindex(columns=COLUMNAS_DATOS).fillna("").astype(str)
+
+    def descargar_datos(self):
+        with self._conexion() as con:
+            df = self._consultar_datos(con)
+        return df, {"ultima_posicion": int(df.index.max()) if len(df) else 0}
+
+    def leer_cambios(self, entrada):
+        ultima = entrada["ultima_posicion"]
+        marca = entrada["marca_agua"]
+        marca = marca.strftime("%Y-%m-%d %H:%M:%S") if pd.notna(marca) else ""
+        with self._conexion() as con:
+            # Filas borradas: la instantánea ya no sirve
+            conocidas = con.execute("SELECT COUNT(*) FROM datos WHERE posicion <= ?", (ultima,)).fetchone()[0]
+            if conocidas != (entrada["df"].index <= ultima).sum():
+                return None
+            # >=: la fecha tiene resolución de un segundo. De las candidatas solo
+            # se descargan las nuevas y las que difieren de la instantánea, así
+            # que las filas que comparten la marca (p. ej. una carga masiva) no
+            # se releen completas en cada sincronización
+            candidatas = pd.read_sql_query(
+                "SELECT posicion, ultima_modificacion_fecha FROM datos "
+                "WHERE posicion > ? OR (ultima_modificacion_fecha >= ? AND ultima_modificacion_fecha != '')",
+                con, params=(ultima, marca), index_col="posicion")["ultima_modificacion_fecha"]
+            fechas = _parsear_fechas(candidatas.astype(object))
+            distintas = (_fechas_distintas(fechas, entrada["df"]["ultima_modificacion_fecha"])
+                         | ~fechas.index.isin(entrada["df"].index))
+            posiciones = distintas[distintas].index.tolist()
+            bloques = []
+            for i in range(0, len(posiciones), MAX_PARAMETROS_SQLITE):
+                lote = posiciones[i:i + MAX_PARAMETROS_SQLITE]
+                bloques.append(self._consultar_datos(
+                    con, f"WHERE posicion IN ({', '.join('?' * len(lote))})", lote))
+            df = pd.concat(bloques) if bloques else self._consultar_datos(con, "WHERE 0")
+        extra = {"ultima_posicion": max([ultima] + candidatas.index.tolist())}
+        if fechas.notna().any():
+            extra["marca_agua"] = max([m for m in (entrada["marca_agua"], fechas.max()) if pd.notna(m)])
+        return df, df.index.tolist(), extra
+
+    def agregar_filas(self, filas, prioridad="interactiva"):
+        with self._conexion() as con:
+            return [con.execute(_INSERTAR_DATOS_SQLITE, fila).lastrowid for fila in filas]
+
+    def leer_fila(self, id_registro, posicion):
+        columnas = ", ".join(f'"{c}"' for c in COLUMNAS_DATOS)
+        with self._conexion() as con:
+            encontrado = con.execute(f"SELECT posicion, {columnas} FROM datos WHERE id = ?",
+                                     (str(id_registro).strip(),)).fetchone()
+        if encontrado is None:
+            return None
+        return encontrado[0], list(encontrado[1:])
+
+    def escribir_celdas(self, posicion, cambios, version):
+        # Escritura condicional: solo si nadie modificó el registro desde que se leyó
+        asignaciones = ", ".join(f'"{c}" = ?' for c in cambios)
+        with self._conexion() as con:
+            cursor = con.execute(
+                f"UPDATE datos SET {asignaciones} WHERE posicion = ? AND ultima_modificacion_fecha = ?",
+                (*cambios.values(), posicion, version))
+        return cursor.rowcount == 1
+
+    def leer_usuarios(self):
+        with self._conexion() as con:
+            con.row_factory = sqlite3.Row
+            return [dict(r) for r in con.execute("SELECT * FROM usuarios")]
+
+    def agregar_usuario(self, fila):
+        with self._conexion() as con:
+            con.execute(_INSERTAR_USUARIO_SQLITE, fila)
+
+    def vacio(self):
+        """True si la base no tiene registros ni usuarios."""
+        with self._conexion() as con:
+            return not con.execute(_CON_DATOS_SQLITE).fetchone()[0]
+
+    def importar(self, filas, usuarios):
+        """
+        Carga inicial de registros y usuarios en una sola transacción (una
+        migración interrumpida no deja la base a medias). Falla si la base ya
+        tiene datos.
+        """
+        with self._conexion() as con:
+            if con.execute(_CON_DATOS_SQLITE).fetchone()[0]:
+                raise ValueError("La base SQLite ya tiene datos; no se importa sobre ella.")
+            con.executemany(_INSERTAR_DATOS_SQLITE, filas)
+            con.executemany(_INSERTAR_USUARIO_SQLITE, usuarios)
+
+
+def migrar_a_sqlite(origen, destino):
+    """
+    Copia DATOS y USUARIOS de `origen` (p. ej. Google Sheets) a la base SQLite
+    `destino`, que debe estar vacía, conservando el orden de los registros.
+    Retorna (registros, usuarios) copiados.
+    """
+    df, _ = origen.descargar_datos()
+    filas = df.reindex(columns=COLUMNAS_DATOS).fillna("").astype(str).values.tolist()
+    usuarios = [[str(u.get(c, "")) for c in COLUMNAS_USUARIOS] for u in origen.leer_usuarios()]
+    destino.importar(filas, usuarios)
+    return len(filas), len(usuarios)
+
+
+@st.cache_resource(show_spinner=False)
+def _inicializar_sqlite(ruta):
+    """
+    Primer arranque sobre una base SQLite (una vez por proceso):
+    - con st.secrets["sqlite_migrar_desde_gsheets"] = true y la base vacía, copia
+      DATOS y USUARIOS del spreadsheet configurado;
+    - si la base no tiene usuarios, crea el usuario SECRETARIA de
+      st.secrets["admin_inicial"] (usuario, password_hash, nombre_completo).
+    """
+    almacen = AlmacenSQLite(ruta)
+    if _secreto("sqlite_migrar_desde_gsheets", False) and almacen.vacio():
+        spreadsheet = _conexion_gsheets(st.secrets["spreadsheet_id"])
+        migrar_a_sqlite(AlmacenGoogleSheets(spreadsheet), almacen)
+    admin = _secreto("admin_inicial")
+    if admin and not almacen.leer_usuarios():
+        almacen.agregar_usuario([admin["usuario"], admin["password_hash"],
+                                 admin.get("nombre_completo", admin["usuario"]), "SECRETARIA", ""])
+    return True
+
+
+def _secreto(clave, defecto=None):
+    """Valor de st.secrets, o el defecto si no existe (o no hay archivo de secretos)."""
     try:
-        return spreadsheet.worksheet("USUARIOS")
-    except gspread.exceptions.WorksheetNotFound:
-        hoja = spreadsheet.add_worksheet(title="USUARIOS", rows=100, cols=5)
-        hoja.append_row(["usuario", "password_hash", "nombre_completo", "rol", "eps_asignada"])
-        return hoja
+        return st.secrets.get(clave, defecto)
+    except FileNotFoundError:
+        return defecto
+
+
+def obtener_almacen():
+    """
+    Retorna el almacén configurado en st.secrets["almacenamiento"]:
+    "gsheets" (por defecto) o "sqlite" (archivo en st.secrets["sqlite_ruta"],
+    preparado por _inicializar_sqlite).
+    Retorna None si no se pudo conectar.
+    """
+    if _secreto("almacenamiento", "gsheets") == "sqlite":
+        ruta = _secreto("sqlite_ruta", "sivigila.db")
+        try:
+            _inicializar_sqlite(ruta)
+        except Exception as e:
+            st.error(f"❌ Error al preparar la base SQLite: {str(e)}")
+            return None
+        return AlmacenSQLite(ruta)
+    spreadsheet = obtener_conexion_gsheets()
+    return AlmacenGoogleSheets(spreadsheet) if spreadsheet else None
 
 
 # ============================================================
 # FUNCIONES DE DATOS (CRUD)
 # ============================================================
 
-def cargar_datos(spreadsheet, forzar=False):
+def _parsear_fechas(serie):
+    """
+    Convierte texto a datetime. Lo que no sea ISO se interpreta valor a valor
+    (solo los únicos) con el día primero, como las fechas de la base SIVIGILA.
     """
-    Carga todos los registros de la hoja DATOS como DataFrame.
-    Usa caché de session_state con TTL manual para no saturar la API.
+    if pd.api.types.is_datetime64_any_dtype(serie):
+        return serie
+    fechas = pd.to_datetime(serie, errors="coerce", format="ISO8601")
+    pendientes = fechas.isna() & (serie.astype(str).str.strip() != "")
+    if pendientes.any():
+        convertidos = {v: pd.to_datetime(v, errors="coerce", dayfirst=True)
+                       for v in serie[pendientes].unique()}
+        fechas[pendientes] = serie[pendientes].map(convertidos)
+    return fechas
+
+
+def tipar_datos(df):
     """
+    Aplica ESQUEMA_DATOS al DataFrame de DATOS: categorías, fechas y enteros
+    Int16 nulables (una celda vacía queda <NA>, no 0: edad 0 es un valor válido).
+    Se ejecuta una vez al cargar; es idempotente.
+    """
+    columnas = {}
+    for col, tipo in ESQUEMA_DATOS.items():
+        if tipo == "categoria":
+            columnas[col] = df[col].astype("category")
+        elif tipo in ("fecha", "fecha_hora"):
+            columnas[col] = _parsear_fechas(df[col])
+        elif tipo == "entero":
+            numeros = pd.to_numeric(df[col], errors="coerce")
+            numeros = numeros.where((numeros.abs() < 2 ** 15).fillna(False))
+            columnas[col] = np.trunc(numeros).astype("Int16")
+    return df.assign(**columnas)
+
+
+def valor_a_celda(col, valor):
+    """Convierte un valor (tipado o texto) al texto que se escribe en la hoja."""
+    if valor is None or (not isinstance(valor, str) and pd.isna(valor)):
+        return ""
+    if isinstance(valor, (pd.Timestamp, datetime, date)):
+        if ESQUEMA_DATOS.get(col) == "fecha_hora":
+            return valor.strftime("%Y-%m-%d %H:%M:%S")
+        return valor.strftime("%Y-%m-%d")
+    return str(valor)
+
+
+def entero_o_none(valor):
+    """Entero de un valor tipado (Int16 nulable) o de texto; None si está vacío."""
+    numero = pd.to_numeric(valor, errors="coerce") if isinstance(valor, str) else valor
+    return None if numero is None or pd.isna(numero) else int(numero)
+
+
+def fila_para_hoja(datos_dict):
+    """Arma la fila de la hoja DATOS (en el orden de COLUMNAS_DATOS) desde un diccionario."""
+    return [valor_a_celda(col, datos_dict.get(col, "")) for col in COLUMNAS_DATOS]
+
+
+def fechas_a_texto(serie):
+    """Serie de fechas como texto YYYY-MM-DD ("" si no hay fecha)."""
+    return _parsear_fechas(serie).dt.strftime("%Y-%m-%d").fillna("")
+
+
+TTL_CACHE_DATOS = 60  # segundos
+TTL_RECARGA_COMPLETA = 600  # segundos; cubre ediciones hechas directamente en la hoja
+MAX_INTENTOS_INSTALACION = 3  # sincronizaciones si un write-through gana la carrera
+
+
+@st.cache_resource(show_spinner=False)
+def _cache_datos_global():
+    """
+    Caché de proceso compartida por todas las sesiones.
+    Cada entrada se indexa por la clave del almacén y guarda la instantánea de DATOS.
+    """
+    return {"lock": threading.Lock(), "entradas": {}, "locks_carga": {},
+            "versiones": itertools.count(1)}
+
+
+def _lock_carga(cache, clave):
+    """Retorna el lock que serializa las descargas de un mismo almacén."""
+    with cache["lock"]:
+        return cache["locks_carga"].setdefault(clave, threading.Lock())
+
+
+def invalidar_cache_datos(almacen):
+    """Marca como vencida la instantánea compartida de DATOS (afecta a todas las sesiones)."""
+    cache = _cache_datos_global()
+    with cache["lock"]:
+        entrada = cache["entradas"].get(almacen.clave)
+        if entrada:
+            entrada["tiempo"] = 0
+
+
+def _marca_agua(valores):
+    """Fecha de modificación más reciente (NaT si no hay fechas válidas)."""
+    return _parsear_fechas(pd.Series(valores, dtype=object)).max()
+
+
+def _fechas_distintas(fechas, cacheadas):
+    """
+    Máscara de las posiciones de `fechas` cuya fecha de modificación difiere de
+    la cacheada (dos vacías cuentan como iguales).
+    """
+    cacheadas = cacheadas.reindex(fechas.index)
+    return ~((fechas == cacheadas) | (fechas.isna() & cacheadas.isna()))
+
+
+def _indexar_ids(df):
+    """Índice id → posición del registro en el almacén (índice del DataFrame)."""
+    ids = df["id"].astype(str).str.strip()
+    return {i: p for i, p in zip(ids, df.index) if i}
+
+
+def _estado_completo(almacen):
+    """Descarga completa de DATOS. Retorna la entrada de caché."""
+    df_texto, extra = almacen.descargar_datos()
+    df = tipar_datos(df_texto)
     ahora = time.time()
-    cache_key = "_datos_cache"
-    cache_time_key = "_datos_cache_time"
+    return {
+        "df": df,
+        "version": next(_cache_datos_global()["versiones"]),
+        "marca_agua": _marca_agua(df["ultima_modificacion_fecha"]),
+        "posiciones_por_id": _indexar_ids(df),
+        "tiempo": ahora,
+        "tiempo_completo": ahora,
+        **extra,
+    }
+
+
+def _estado_incremental(almacen, entrada):
+    """
+    Sincronización incremental: fusiona en la instantánea solo las filas que
+    el almacén reporta como agregadas o modificadas (ver leer_cambios).
+    Retorna la nueva entrada, o None si el almacén pide una descarga completa.
+    """
+    cambios = almacen.leer_cambios(entrada)
+    if cambios is None:
+        return None
+    df_delta, leidas, extra = cambios
+    nuevo = dict(entrada, tiempo=time.time(), **extra)
+    if not leidas:
+        return nuevo
+    # La marca avanza aunque las filas releídas ya estén en la instantánea
+    # (escrituras locales): si no, se volverían a leer en cada sincronización
+    marca = _marca_agua(df_delta["ultima_modificacion_fecha"])
+    nuevo["marca_agua"] = max([m for m in (nuevo["marca_agua"], marca) if pd.notna(m)], default=pd.NaT)
+
+    # Una fila releída sin cambios (misma fecha, p. ej. escrita en este proceso)
+    # no se fusiona
+    df_nuevas = tipar_datos(df_delta)
+    df = entrada["df"]
+    conocidas = df_nuevas.index.intersection(df.index)
+    if len(conocidas):
+        iguales = (df_nuevas.loc[conocidas, COLUMNAS_DATOS].astype(str).fillna("")
+                   == df.loc[conocidas, COLUMNAS_DATOS].astype(str).fillna("")).all(axis=1)
+        df_nuevas = df_nuevas.drop(index=iguales[iguales].index)
+    if df_nuevas.empty:
+        return nuevo
+
+    return _fusionar_filas(nuevo, df_nuevas.index.tolist(), df_nuevas)
+
+
+def _fusionar_filas(entrada, posiciones, df_nuevas):
+    """
+    Nueva entrada de caché en la que las filas de `posiciones` se reemplazan por
+    df_nuevas (tipado, indexado por posición). Las estructuras derivadas (cubo,
+    alertas, índices) se ajustan con la diferencia y el motor de filtros se
+    descarta. La entrada anterior no se modifica: las sesiones que aún usan su
+    df, o una reconciliación que la descarte, siguen viendo sus propios índices.
+    """
+    df = entrada["df"]
+    anteriores = df.loc[df.index.intersection(posiciones)]
+    nueva = dict(entrada, version=next(_cache_datos_global()["versiones"]))
+    nueva.pop("motor", None)
+    # Re-tipar tras concatenar unifica las categorías nuevas
+    nueva["df"] = tipar_datos(
+        pd.concat([df.drop(index=posiciones, errors="ignore"), df_nuevas]).sort_index())
+    nueva["posiciones_por_id"] = {**entrada["posiciones_por_id"], **_indexar_ids(df_nuevas)}
+    if "cubo" in entrada:
+        nueva["cubo"] = ajustar_cubo(entrada["cubo"], anteriores, df_nuevas)
+    if "alertas" in entrada:
+        nueva["alertas"] = ajustar_alertas(entrada["alertas"], anteriores, df_nuevas)
+    if "busqueda" in entrada:
+        nueva["busqueda"] = ajustar_indice_busqueda(entrada["busqueda"], anteriores, df_nuevas)
+    if "documentos" in entrada:
+        nueva["documentos"] = ajustar_indice_documentos(entrada["documentos"], anteriores, df_nuevas)
+    return nueva
+
+
+def posicion_de_id(almacen, id_registro):
+    """Posición del registro según el índice de la caché (None si no se conoce)."""
+    entrada = _cache_datos_global()["entradas"].get(almacen.clave)
+    if not entrada:
+        return None
+    return entrada["posiciones_por_id"].get(str(id_registro).strip())
 
-    if not forzar and cache_key in st.session_state:
-        if ahora - st.session_state.get(cache_time_key, 0) < 60:
-            return st.session_state[cache_key]
 
-    try:
-        hoja = obtener_hoja_datos(spreadsheet)
-        all_values = hoja.get_all_values()
-        if len(all_values) > 1:
-            num_cols = len(COLUMNAS_DATOS)
-            # Forzar encabezados definidos (ignorar lo que diga la hoja)
-            # Rellenar filas cortas con cadenas vacías
-            datos = [(row + [''] * num_cols)[:num_cols] for row in all_values[1:]]
-            df = pd.DataFrame(datos, columns=COLUMNAS_DATOS)
-            # Eliminar filas completamente vacías
-            df = df[df.apply(lambda row: any(str(v).strip() != '' for v in row), axis=1)]
-        else:
-            df = pd.DataFrame(columns=COLUMNAS_DATOS)
-        st.session_state[cache_key] = df
-        st.session_state[cache_time_key] = ahora
-        return df
-    except Exception as e:
-        st.error(f"❌ Error al cargar datos: {str(e)}")
-        return pd.DataFrame(columns=COLUMNAS_DATOS)
+def reconciliar_cache_datos(almacen):
+    """
+    Sincroniza la instantánea con el almacén en un hilo aparte.
+    Si la instantánea cambió mientras tanto (otra escritura u otra carga), no se
+    reemplaza: la próxima sincronización la pondrá al día.
+    """
+    def tarea():
+        cache = _cache_datos_global()
+        with _lock_carga(cache, almacen.clave):
+            entrada = cache["entradas"].get(almacen.clave)
+            if entrada is None:
+                return
+            try:
+                nueva = _estado_incremental(almacen, entrada) or _estado_completo(almacen)
+            except Exception as e:
+                reconectar_si_corresponde(e)
+                invalidar_cache_datos(almacen)
+                return
+            with cache["lock"]:
+                if cache["entradas"].get(almacen.clave) is entrada:
+                    cache["entradas"][almacen.clave] = nueva
+
+    threading.Thread(target=tarea, daemon=True).start()
+
+
+def escribir_en_cache(almacen, filas, posiciones, reconciliar=True):
+    """
+    Write-through: refleja en la instantánea compartida filas recién guardadas
+    o actualizadas (filas de la hoja y sus posiciones) sin volver a descargar
+    DATOS, y reconcilia con el almacén en segundo plano. La reconciliación solo
+    relee las filas cuya fecha de modificación en el almacén difiera de la escrita.
+    Si no hay instantánea o no se conocen las posiciones, solo la invalida.
+    """
+    cache = _cache_datos_global()
+    with cache["lock"]:
+        entrada = cache["entradas"].get(almacen.clave)
+        conocidas = entrada is not None and posiciones is not None
+        if conocidas:
+            df_nuevas = tipar_datos(pd.DataFrame(filas, columns=COLUMNAS_DATOS, index=posiciones))
+            cache["entradas"][almacen.clave] = _fusionar_filas(entrada, posiciones, df_nuevas)
+    if not conocidas:
+        invalidar_cache_datos(almacen)
+    elif reconciliar:
+        reconciliar_cache_datos(almacen)
+
+
+def cargar_datos(almacen, forzar=False, completo=False):
+    """
+    Carga todos los registros de DATOS como DataFrame.
+    Las columnas vienen tipadas según ESQUEMA_DATOS (ver tipar_datos).
+    La instantánea se comparte entre todas las sesiones del proceso (clave del
+    almacén) con TTL de 60 s. Es de solo lectura: no modificarla en el lugar.
+    Al vencer (o con forzar=True) se sincroniza de forma incremental; la descarga
+    completa ocurre la primera vez, cada TTL_RECARGA_COMPLETA o con completo=True.
+    """
+    cache = _cache_datos_global()
+    clave = almacen.clave
+    solicitado = time.time()
+
+    entrada = cache["entradas"].get(clave)
+    if not forzar and not completo and entrada and solicitado - entrada["tiempo"] < TTL_CACHE_DATOS:
+        return entrada["df"]
+
+    with _lock_carga(cache, clave):
+        # Otra sesión pudo haber recargado mientras se esperaba el lock
+        entrada = cache["entradas"].get(clave)
+        if entrada and time.time() - entrada["tiempo"] < TTL_CACHE_DATOS:
+            if (not forzar and not completo) or entrada["tiempo"] >= solicitado:
+                return entrada["df"]
+
+        try:
+            for _ in range(MAX_INTENTOS_INSTALACION):
+                nueva = None
+                if (entrada and not completo
+                        and time.time() - entrada["tiempo_completo"] < TTL_RECARGA_COMPLETA):
+                    nueva = _estado_incremental(almacen, entrada)
+                if nueva is None:
+                    nueva = _estado_completo(almacen)
+                with cache["lock"]:
+                    actual = cache["entradas"].get(clave)
+                    if actual is entrada:
+                        cache["entradas"][clave] = nueva
+                        return nueva["df"]
+                # Un write-through cambió (o invalidó) la instantánea durante la
+                # lectura: se sincroniza de nuevo a partir de la vigente
+                entrada = actual
+            return (actual or nueva)["df"]
+        except Exception as e:
+            reconectar_si_corresponde(e)
+            st.error(f"❌ Error al cargar datos: {str(e)}")
+            return tipar_datos(pd.DataFrame(columns=COLUMNAS_DATOS))
 
 
 def col_num_a_letra(n):
@@ -340,76 +1219,405 @@ def col_num_a_letra(n):
     return resultado
 
 
+IDS_POR_SEGUNDO = 10000
+
+
+@st.cache_resource(show_spinner=False)
+def _asignador_ids():
+    """
+    Estado del asignador de IDs, compartido por todas las sesiones del proceso.
+    `proceso` es un discriminador aleatorio de este proceso: dos workers (o un
+    reinicio dentro del mismo segundo) no generan los mismos IDs.
+    """
+    return {"lock": threading.Lock(), "segundo": datetime.min, "siguiente": 0,
+            "proceso": os.urandom(3).hex().upper()}
+
+
+def reservar_ids(cantidad):
+    """
+    Reserva un bloque de `cantidad` IDs únicos, crecientes y ordenables
+    (CS-AAAAMMDDHHMMSS-NNNN-PPPPPP, con PPPPPP el discriminador del proceso) en
+    una sola llamada. Si se agotan los IDS_POR_SEGUNDO de un segundo, el bloque
+    continúa en el segundo siguiente.
+    """
+    estado = _asignador_ids()
+    ids = []
+    with estado["lock"]:
+        segundo = datetime.now().replace(microsecond=0)
+        if segundo > estado["segundo"]:
+            secuencia = 0
+        else:
+            segundo, secuencia = estado["segundo"], estado["siguiente"]
+        while len(ids) < cantidad:
+            tomar = min(IDS_POR_SEGUNDO - secuencia, cantidad - len(ids))
+            marca = segundo.strftime('%Y%m%d%H%M%S')
+            ids.extend(f"CS-{marca}-{n:04d}-{estado['proceso']}" for n in range(secuencia, secuencia + tomar))
+            secuencia += tomar
+            if secuencia >= IDS_POR_SEGUNDO:
+                segundo += timedelta(seconds=1)
+                secuencia = 0
+        estado["segundo"], estado["siguiente"] = segundo, secuencia
+    return ids
+
+
 def generar_id():
-    """Genera un ID único basado en timestamp."""
-    return f"CS-{datetime.now().strftime('%Y%m%d%H%M%S')}-{int(time.time()*1000) % 10000}"
+    """Genera un ID único (ver reservar_ids)."""
+    return reservar_ids(1)[0]
 
 
-def guardar_registro(spreadsheet, datos_dict):
+def guardar_registro(almacen, datos_dict):
     """
-    Guarda un nuevo registro en la hoja DATOS.
+    Guarda un nuevo registro en DATOS.
     datos_dict: diccionario con las columnas como claves.
     """
     try:
-        hoja = obtener_hoja_datos(spreadsheet)
         datos_dict["id"] = generar_id()
         datos_dict["fecha_digitacion"] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
         datos_dict["ultima_modificacion_por"] = datos_dict.get("funcionario_reporta", "")
         datos_dict["ultima_modificacion_fecha"] = datos_dict["fecha_digitacion"]
 
-        fila = [str(datos_dict.get(col, "")) for col in COLUMNAS_DATOS]
-        hoja.append_row(fila, value_input_option="USER_ENTERED", table_range="A1")
+        fila = fila_para_hoja(datos_dict)
+        posiciones = almacen.agregar_filas([fila])
 
-        # Invalidar caché
-        if "_datos_cache_time" in st.session_state:
-            st.session_state["_datos_cache_time"] = 0
+        # Reflejar el registro en la caché compartida (write-through)
+        escribir_en_cache(almacen, [fila], posiciones)
 
         return True, datos_dict["id"]
     except Exception as e:
+        reconectar_si_corresponde(e)
         return False, str(e)
 
 
-def actualizar_registro(spreadsheet, id_registro, datos_dict, usuario_modifica):
+def _fila_canonica(fila):
+    """Fila de texto de DATOS → {columna: texto canónico} (mismo tipado que la caché)."""
+    tipada = tipar_datos(pd.DataFrame([fila], columns=COLUMNAS_DATOS)).iloc[0]
+    return {col: valor_a_celda(col, tipada[col]) for col in COLUMNAS_DATOS}
+
+
+def registro_en_cache(almacen, id_registro):
+    """Registro (tipado) de la instantánea compartida, o None si no está."""
+    posicion = posicion_de_id(almacen, id_registro)
+    entrada = _cache_datos_global()["entradas"].get(almacen.clave)
+    if posicion is None or entrada is None or posicion not in entrada["df"].index:
+        return None
+    return entrada["df"].loc[posicion].to_dict()
+
+
+def actualizar_registro(almacen, id_registro, datos_dict, usuario_modifica, original=None):
     """
     Actualiza un registro existente buscando por ID.
+    Solo escribe las columnas que cambiaron respecto a `original` (el registro
+    que se editó; por defecto, el de la caché). Si otro usuario modificó el
+    registro mientras tanto, rechaza la edición cuando ambos cambiaron las
+    mismas columnas; si no, conserva los cambios de los dos.
     """
     try:
-        hoja = obtener_hoja_datos(spreadsheet)
-        # Buscar la fila con el ID
-        celdas_col_a = hoja.col_values(1)  # Columna A = id
-        fila_num = None
-        for i, valor in enumerate(celdas_col_a):
-            if valor.strip() == str(id_registro).strip():
-                fila_num = i + 1  # gspread es 1-indexado
-                break
-
-        if fila_num is None:
+        id_registro = str(id_registro).strip()
+        encontrado = almacen.leer_fila(id_registro, posicion_de_id(almacen, id_registro))
+        if encontrado is None:
             return False, "Registro no encontrado."
+        posicion, fila_actual = encontrado
+        actual = _fila_canonica(fila_actual)
+
+        if original is None:
+            original = registro_en_cache(almacen, id_registro)
+        base = ({col: valor_a_celda(col, original.get(col, "")) for col in COLUMNAS_DATOS}
+                if original is not None else actual)
+        nuevo = _fila_canonica(fila_para_hoja(datos_dict))
+        auditoria = ("ultima_modificacion_por", "ultima_modificacion_fecha")
+        cambiadas = [col for col in COLUMNAS_DATOS
+                     if col in datos_dict and col not in auditoria and nuevo[col] != base[col]]
+        if not cambiadas:
+            return True, "Sin cambios: no se modificó ningún campo."
+
+        # Conflicto: el registro cambió en el almacén y toca columnas editadas aquí
+        if actual["ultima_modificacion_fecha"] != base["ultima_modificacion_fecha"]:
+            ajenas = [col for col in cambiadas if actual[col] != base[col]]
+            if ajenas:
+                return False, (f"El registro cambió después de abrirlo (última modificación: "
+                               f"{actual['ultima_modificacion_por'] or 'otro usuario'}, "
+                               f"{actual['ultima_modificacion_fecha']}; campos en conflicto: {', '.join(ajenas)}). "
+                               "Recargue el registro antes de editarlo.")
 
         datos_dict["ultima_modificacion_por"] = usuario_modifica
         datos_dict["ultima_modificacion_fecha"] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        fila = fila_para_hoja(datos_dict)
+        cambios = {col: fila[COLUMNAS_DATOS.index(col)] for col in cambiadas + list(auditoria)}
+        version = fila_actual[COLUMNAS_DATOS.index("ultima_modificacion_fecha")]
+        if not almacen.escribir_celdas(posicion, cambios, version):
+            return False, "El registro fue modificado por otro usuario. Recargue el registro antes de editarlo."
 
-        fila = [str(datos_dict.get(col, "")) for col in COLUMNAS_DATOS]
-        # Actualizar rango completo de la fila
-        rango = f"A{fila_num}:{col_num_a_letra(len(COLUMNAS_DATOS))}{fila_num}"
-        hoja.update(rango, [fila], value_input_option="USER_ENTERED")
-
-        # Invalidar caché
-        if "_datos_cache_time" in st.session_state:
-            st.session_state["_datos_cache_time"] = 0
+        # Reflejar el registro en la caché compartida (write-through)
+        fila_final = [cambios.get(col, valor) for col, valor in zip(COLUMNAS_DATOS, fila_actual)]
+        escribir_en_cache(almacen, [fila_final], [posicion])
 
-        return True, "Actualizado correctamente."
+        return True, f"Actualizado correctamente ({len(cambiadas)} campo(s))."
     except Exception as e:
+        reconectar_si_corresponde(e)
         return False, str(e)
 
 
-def buscar_por_documento(df, numero_doc):
+def _nuevo_indice_documentos(df):
+    """Índice número de documento → posiciones, para un DataFrame tipado de DATOS."""
+    indice = {"lock": threading.Lock(), "posiciones": {}}
+    return ajustar_indice_documentos(indice, df.iloc[:0], df)
+
+
+def ajustar_indice_documentos(indice, quitar, agregar):
+    """
+    Índice nuevo sin las posiciones de `quitar` y con las de `agregar`. El
+    recibido no se modifica (copia al escribir: solo se copian los grupos que cambian).
+    """
+    with indice["lock"]:
+        posiciones = dict(indice["posiciones"])
+    copiados = set()
+
+    def grupo(documento):
+        if documento not in copiados:
+            posiciones[documento] = set(posiciones.get(documento, ()))
+            copiados.add(documento)
+        return posiciones[documento]
+
+    for posicion, documento in zip(quitar.index, quitar["numero_documento"].astype(str).str.strip()):
+        if documento in posiciones:
+            grupo(documento).discard(posicion)
+    for posicion, documento in zip(agregar.index, agregar["numero_documento"].astype(str).str.strip()):
+        grupo(documento).add(posicion)
+    for documento in copiados:
+        if not posiciones[documento]:
+            del posiciones[documento]
+    return {"lock": threading.Lock(), "posiciones": posiciones}
+
+
+def indice_documentos(almacen, df):
+    """
+    Índice por número de documento del DataFrame `df` tal como lo retornó
+    cargar_datos. Se guarda en la instantánea compartida y se construye la primera vez.
+    """
+    entrada = _cache_datos_global()["entradas"].get(almacen.clave)
+    if entrada is None or entrada["df"] is not df:
+        return _nuevo_indice_documentos(df)
+    if "documentos" not in entrada:
+        entrada["documentos"] = _nuevo_indice_documentos(df)
+    return entrada["documentos"]
+
+
+def posiciones_de_documentos(almacen, df, documentos):
+    """Posiciones de df con alguno de los números de documento dados."""
+    indice = indice_documentos(almacen, df)
+    with indice["lock"]:
+        encontradas = [p for d in set(str(d).strip() for d in documentos)
+                       for p in indice["posiciones"].get(d, ())]
+    return sorted(p for p in encontradas if p in df.index)
+
+
+def buscar_por_documento(almacen, df, numero_doc):
     """Busca pacientes por número de documento."""
     if df.empty:
         return pd.DataFrame()
-    numero_doc = str(numero_doc).strip()
-    resultado = df[df["numero_documento"].astype(str).str.strip() == numero_doc]
-    return resultado
+    return df.loc[posiciones_de_documentos(almacen, df, [numero_doc])]
+
+
+# ============================================================
+# CUBO DE AGREGADOS DEL TABLERO
+# ============================================================
+# Conteos de casos e indicadores por combinación de dimensiones. Los KPIs y
+# gráficas del tablero se responden filtrando y sumando el cubo, que se
+# calcula una vez por instantánea y se ajusta con cada cambio de filas.
+
+# La fecha de notificación entra al cubo por semana (domingo de inicio), no por
+# día: el cubo crece con las semanas del histórico. Los días sueltos de un rango
+# se agregan desde los registros (ver cubo_del_rango).
+DIMENSIONES_CUBO = ["eps_reporta", "municipio_residencia", "ciclo_vital", "sexo",
+                    "estado_caso", "semana_epidemiologica", "semana_notificacion"]
+MEDIDAS_CUBO = ["casos", "reincidentes", "menores_18", "activos_sin_seg",
+                "sin_seguimiento", "abandonos"]
+
+
+def _banderas(df):
+    """Indicadores por registro (Series booleanas) usados en KPIs y alertas."""
+    mayus = lambda col: df[col].astype(str).str.upper()
+    # Sin número de seguimientos registrado cuenta como cero; sin edad no es menor de 18
+    activos_sin_seg = ((mayus("estado_caso") == "ACTIVO")
+                       & (df["num_seguimientos_realizados"].fillna(0) == 0).astype(bool))
+    return {
+        "reincidentes": mayus("intento_previo") == "SI",
+        "menores_18": (df["edad"] < 18).fillna(False).astype(bool),
+        "activos_sin_seg": activos_sin_seg,
+        "sin_seguimiento": activos_sin_seg | mayus("asiste_servicios").isin(["NO", "SIN CONTACTO"]),
+        "abandonos": mayus("abandono_tratamiento") == "SI",
+    }
+
+
+def _cubo_de(df):
+    """Cubo de agregados de un DataFrame tipado de DATOS."""
+    filas = pd.DataFrame({
+        **{d: df[d].astype(object) for d in DIMENSIONES_CUBO[:-2]},
+        "semana_epidemiologica": df["semana_epidemiologica"],
+        "semana_notificacion": inicio_semana(df["fecha_notificacion_sivigila"]),
+        "casos": 1,
+        **_banderas(df),
+    }, index=df.index)
+    return _sumar_cubo(filas)
+
+
+def inicio_semana(fechas):
+    """Domingo en que empieza la semana de cada fecha (semana epidemiológica)."""
+    fechas = fechas.dt.normalize()
+    return fechas - pd.to_timedelta((fechas.dt.dayofweek + 1) % 7, unit="D")
+
+
+def _sumar_cubo(filas):
+    """Suma las medidas por combinación de dimensiones y descarta las celdas vacías."""
+    cubo = filas.groupby(DIMENSIONES_CUBO, dropna=False, sort=False)[MEDIDAS_CUBO].sum().reset_index()
+    cubo[MEDIDAS_CUBO] = cubo[MEDIDAS_CUBO].astype(int)
+    return cubo[cubo["casos"] != 0].reset_index(drop=True)
+
+
+def ajustar_cubo(cubo, quitar, agregar):
+    """
+    Actualiza el cubo restando las filas de `quitar` (versión anterior de los
+    registros) y sumando las de `agregar` (DataFrames tipados de DATOS).
+    """
+    restar = _cubo_de(quitar)
+    restar[MEDIDAS_CUBO] = -restar[MEDIDAS_CUBO]
+    return _sumar_cubo(pd.concat([cubo, restar, _cubo_de(agregar)], ignore_index=True))
+
+
+def cubo_datos(almacen, df):
+    """
+    Cubo de agregados del DataFrame `df` tal como lo retornó cargar_datos.
+    Se guarda en la instantánea compartida y se calcula la primera vez que se pide.
+    """
+    entrada = _cache_datos_global()["entradas"].get(almacen.clave)
+    if entrada is None or entrada["df"] is not df:
+        return _cubo_de(df)
+    if "cubo" not in entrada:
+        entrada["cubo"] = _cubo_de(df)
+    return entrada["cubo"]
+
+
+def contar_por(cubo, columna):
+    """Casos por valor de la dimensión del cubo, sin los valores que no aparecen."""
+    conteo = cubo.groupby(columna)["casos"].sum().sort_values(ascending=False)
+    conteo = conteo[conteo > 0]
+    conteo.index = conteo.index.astype(str)
+    return conteo
+
+
+def filtrar_cubo(cubo, filtros):
+    """Aplica los filtros del tablero ({columna: valores}) al cubo."""
+    mascara = pd.Series(True, index=cubo.index)
+    for columna, valores in filtros.items():
+        if valores:
+            mascara &= cubo[columna].isin(valores)
+    return cubo[mascara]
+
+
+def cubo_del_rango(cubo, motor, rango_fechas):
+    """
+    Cubo restringido al rango de fechas de notificación. Las semanas completas
+    del rango salen del cubo; los días de los extremos (a lo sumo seis por lado)
+    se agregan desde los registros, ubicados por búsqueda binaria en el índice
+    ordenado de fechas del motor. Las filas de los extremos no vienen filtradas
+    por rol.
+    """
+    if not _es_rango(rango_fechas):
+        return cubo
+    inicio, fin = pd.Timestamp(rango_fechas[0]), pd.Timestamp(rango_fechas[1])
+    # Semanas completas: domingo >= inicio y sábado <= fin
+    primera = inicio_semana(pd.Series([inicio + pd.Timedelta(days=6)]))[0]
+    ultima = inicio_semana(pd.Series([fin - pd.Timedelta(days=6)]))[0]
+    if primera <= ultima:
+        semanas = cubo[(cubo["semana_notificacion"] >= primera) & (cubo["semana_notificacion"] <= ultima)]
+        extremos = [(inicio, primera - pd.Timedelta(days=1)), (ultima + pd.Timedelta(days=7), fin)]
+    else:
+        semanas = cubo.iloc[:0]
+        extremos = [(inicio, fin)]
+
+    fechas, orden = motor["fechas_ordenadas"], motor["orden_fechas"]
+    posiciones = [orden[np.searchsorted(fechas, np.datetime64(a), "left"):
+                        np.searchsorted(fechas, np.datetime64(b), "right")]
+                  for a, b in extremos if a <= b]
+    dias = motor["df"].iloc[np.concatenate(posiciones)] if posiciones else motor["df"].iloc[:0]
+    return pd.concat([semanas, _cubo_de(dias)], ignore_index=True)
+
+
+def _es_rango(rango_fechas):
+    """True si el valor del date_input es un rango completo (inicio, fin)."""
+    return bool(rango_fechas) and isinstance(rango_fechas, tuple) and len(rango_fechas) == 2
+
+
+# ============================================================
+# MOTOR DE FILTROS DE REGISTROS
+# ============================================================
+# Filtra la instantánea de DATOS sin copias intermedias: cada columna filtrable
+# se guarda como códigos enteros de categoría y cada valor pedido se resuelve
+# una sola vez a un mapa de bits (arreglo booleano). Una combinación de filtros
+# es un OR de mapas por columna y un AND entre columnas.
+
+COLUMNAS_FILTRO = ["eps_reporta", "municipio_residencia", "ciclo_vital", "estado_caso"]
+
+
+def _nuevo_motor(df):
+    """Motor de filtros para un DataFrame tipado de DATOS."""
+    dias = df["fecha_notificacion_sivigila"].dt.normalize().to_numpy()
+    orden = np.argsort(dias, kind="stable")
+    return {
+        "df": df,
+        "codigos": {col: (df[col].cat.categories, df[col].cat.codes.to_numpy())
+                    for col in COLUMNAS_FILTRO},
+        "mapas": {},
+        "fechas": df["fecha_notificacion_sivigila"].to_numpy(),
+        # Posiciones de los registros ordenadas por día de notificación (NaT al final)
+        "orden_fechas": orden,
+        "fechas_ordenadas": dias[orden],
+    }
+
+
+def motor_filtros(almacen, df):
+    """
+    Motor de filtros del DataFrame `df` tal como lo retornó cargar_datos.
+    Se guarda en la instantánea compartida; los mapas de bits se memorizan.
+    """
+    entrada = _cache_datos_global()["entradas"].get(almacen.clave)
+    if entrada is None or entrada["df"] is not df:
+        return _nuevo_motor(df)
+    if "motor" not in entrada:
+        entrada["motor"] = _nuevo_motor(df)
+    return entrada["motor"]
+
+
+def _mapa_de_valor(motor, columna, valor):
+    """Mapa de bits de los registros con columna == valor."""
+    mapa = motor["mapas"].get((columna, valor))
+    if mapa is None:
+        categorias, codigos = motor["codigos"][columna]
+        codigo = categorias.get_indexer([valor])[0]
+        mapa = codigos == codigo if codigo >= 0 else np.zeros(len(codigos), dtype=bool)
+        motor["mapas"][(columna, valor)] = mapa
+    return mapa
+
+
+def mascara_filtros(motor, filtros, rango_fechas=None):
+    """
+    Mapa de bits de los registros que cumplen los filtros ({columna: valores})
+    y el rango de fechas de notificación.
+    """
+    mascara = np.ones(len(motor["df"]), dtype=bool)
+    for columna, valores in filtros.items():
+        if valores:
+            mascara &= np.logical_or.reduce([_mapa_de_valor(motor, columna, v) for v in valores])
+    if _es_rango(rango_fechas):
+        fechas = motor["fechas"]
+        mascara &= ((fechas >= np.datetime64(pd.Timestamp(rango_fechas[0])))
+                    & (fechas <= np.datetime64(pd.Timestamp(rango_fechas[1]))))
+    return mascara
+
+
+def filtrar_registros(motor, filtros, rango_fechas=None):
+    """Registros de la instantánea que cumplen los filtros (ver mascara_filtros)."""
+    return motor["df"][mascara_filtros(motor, filtros, rango_fechas)]
 
 
 # ============================================================
@@ -421,14 +1629,13 @@ def hash_password(password):
     return hashlib.sha256(password.encode()).hexdigest()
 
 
-def verificar_credenciales(spreadsheet, usuario, password):
+def verificar_credenciales(almacen, usuario, password):
     """
-    Verifica las credenciales contra la hoja USUARIOS.
+    Verifica las credenciales contra la tabla USUARIOS.
     Retorna (True, datos_usuario) o (False, None).
     """
     try:
-        hoja = obtener_hoja_usuarios(spreadsheet)
-        registros = hoja.get_all_records()
+        registros = almacen.leer_usuarios()
         password_hash = hash_password(password)
 
         for reg in registros:
@@ -442,15 +1649,15 @@ def verificar_credenciales(spreadsheet, usuario, password):
                 }
         return False, None
     except Exception as e:
+        reconectar_si_corresponde(e)
         st.error(f"Error de autenticación: {str(e)}")
         return False, None
 
 
-def crear_usuario(spreadsheet, usuario, password, nombre_completo, rol, eps_asignada):
-    """Crea un nuevo usuario en la hoja USUARIOS."""
+def crear_usuario(almacen, usuario, password, nombre_completo, rol, eps_asignada):
+    """Crea un nuevo usuario en la tabla USUARIOS."""
     try:
-        hoja = obtener_hoja_usuarios(spreadsheet)
-        registros = hoja.get_all_records()
+        registros = almacen.leer_usuarios()
 
         # Verificar duplicados
         for reg in registros:
@@ -458,25 +1665,299 @@ def crear_usuario(spreadsheet, usuario, password, nombre_completo, rol, eps_asig
                 return False, "El usuario ya existe."
 
         password_hash = hash_password(password)
-        hoja.append_row([usuario, password_hash, nombre_completo, rol, eps_asignada])
+        almacen.agregar_usuario([usuario, password_hash, nombre_completo, rol, eps_asignada])
         return True, "Usuario creado exitosamente."
     except Exception as e:
+        reconectar_si_corresponde(e)
         return False, str(e)
 
 
+# ============================================================
+# ALERTAS MATERIALIZADAS
+# ============================================================
+# Conjuntos de ids de cada alerta (con la EPS de cada caso) y conteos por EPS.
+# Se calculan una vez por instantánea y se ajustan con cada cambio de filas.
+
+ALERTAS = ["reincidentes", "sin_seguimiento", "abandonos"]
+
+
+def _alertas_de(df):
+    """Miembros ({id: eps}) y conteos por EPS de cada alerta."""
+    banderas = _banderas(df)
+    ids = df["id"].astype(str).str.strip()
+    eps = df["eps_reporta"].astype(str)
+    miembros = {nombre: dict(zip(ids[banderas[nombre]], eps[banderas[nombre]])) for nombre in ALERTAS}
+    return {"miembros": miembros,
+            "conteos": {nombre: Counter(m.values()) for nombre, m in miembros.items()}}
+
+
+def ajustar_alertas(alertas, quitar, agregar):
+    """
+    Actualiza las alertas sacando los ids de `quitar` (versión anterior de los
+    registros) y agregando los de `agregar` que cumplan cada condición.
+    """
+    miembros = {nombre: dict(m) for nombre, m in alertas["miembros"].items()}
+    conteos = {nombre: Counter(c) for nombre, c in alertas["conteos"].items()}
+    for id_registro in quitar["id"].astype(str).str.strip():
+        for nombre in ALERTAS:
+            eps = miembros[nombre].pop(id_registro, None)
+            if eps is not None:
+                conteos[nombre][eps] -= 1
+    nuevas = _alertas_de(agregar)["miembros"]
+    for nombre in ALERTAS:
+        for id_registro, eps in nuevas[nombre].items():
+            anterior = miembros[nombre].get(id_registro)
+            if anterior is not None:
+                conteos[nombre][anterior] -= 1
+            miembros[nombre][id_registro] = eps
+            conteos[nombre][eps] += 1
+    return {"miembros": miembros, "conteos": {n: +c for n, c in conteos.items()}}
+
+
+def alertas_datos(almacen, df):
+    """
+    Alertas materializadas del DataFrame `df` tal como lo retornó cargar_datos.
+    Se guardan en la instantánea compartida y se calculan la primera vez.
+    """
+    entrada = _cache_datos_global()["entradas"].get(almacen.clave)
+    if entrada is None or entrada["df"] is not df:
+        return _alertas_de(df)
+    if "alertas" not in entrada:
+        entrada["alertas"] = _alertas_de(df)
+    return entrada["alertas"]
+
+
+def conteo_alertas(almacen, df, eps=None):
+    """Casos en cada alerta: totales, o solo de la EPS indicada."""
+    conteos = alertas_datos(almacen, df)["conteos"]
+    if eps:
+        return {nombre: conteos[nombre].get(eps, 0) for nombre in ALERTAS}
+    return {nombre: sum(conteos[nombre].values()) for nombre in ALERTAS}
+
+
+def mascara_alerta(almacen, df, nombre):
+    """Mapa de bits (alineado con df) de los registros que están en la alerta."""
+    ids = alertas_datos(almacen, df)["miembros"][nombre]
+    entrada = _cache_datos_global()["entradas"].get(almacen.clave)
+    if entrada is None or entrada["df"] is not df:
+        return df["id"].astype(str).str.strip().isin(ids).to_numpy()
+    posiciones_por_id = entrada["posiciones_por_id"]
+    indices = df.index.get_indexer([posiciones_por_id[i] for i in ids if i in posiciones_por_id])
+    mascara = np.zeros(len(df), dtype=bool)
+    mascara[indices[indices >= 0]] = True
+    return mascara
+
+
+# ============================================================
+# ÍNDICE DE BÚSQUEDA (nombres y documentos)
+# ============================================================
+# Postings en memoria sobre texto normalizado (sin tildes, en mayúsculas):
+# prefijos de 1 y 2 caracteres de cada palabra (consultas cortas) y trigramas
+# (consultas de 3 o más caracteres). Los candidatos se verifican contra el
+# texto vigente de cada registro, así que una posting desactualizada nunca
+# produce un resultado falso: solo se agregan postings, no se borran.
+
+
+def normalizar_texto(texto):
+    """Texto sin tildes, en mayúsculas y solo con letras, dígitos y espacios."""
+    texto = unicodedata.normalize("NFKD", str(texto)).encode("ascii", "ignore").decode("ascii")
+    return " ".join(re.sub(r"[^A-Z0-9]+", " ", texto.upper()).split())
+
+
+def _normalizar_serie(serie):
+    """normalizar_texto vectorizado para una columna."""
+    return (serie.astype(str).str.normalize("NFKD").str.encode("ascii", "ignore").str.decode("ascii")
+            .str.upper().str.replace(r"[^A-Z0-9]+", " ", regex=True).str.strip())
+
+
+def _gramas(texto):
+    """Claves de postings de un texto normalizado: ^prefijos y trigramas por palabra."""
+    gramas = set()
+    for palabra in texto.split():
+        gramas.add("^" + palabra[:1])
+        gramas.add("^" + palabra[:2])
+        gramas.update(palabra[i:i + 3] for i in range(len(palabra) - 2))
+    return gramas
+
+
+def _indexar_busqueda(indice, df, compartido=False):
+    """
+    Agrega (o reemplaza) en el índice los registros de df. Con compartido=True
+    los conjuntos de gramas son de otro índice y se copian antes de modificarlos.
+    """
+    nombres = _normalizar_serie(df["nombres"].astype(str) + " " + df["apellidos"].astype(str))
+    documentos = _normalizar_serie(df["numero_documento"]).str.replace(" ", "", regex=False)
+    gramas = indice["gramas"]
+    copiados = set()
+    with indice["lock"]:
+        for posicion, nombre, documento in zip(df.index, nombres, documentos):
+            indice["textos"][posicion] = (nombre, documento)
+            for grama in _gramas(nombre) | _gramas(documento):
+                grupo = gramas.get(grama)
+                if grupo is None or (compartido and grama not in copiados):
+                    gramas[grama] = grupo = set(grupo or ())
+                    copiados.add(grama)
+                grupo.add(posicion)
+
+
+def _nuevo_indice_busqueda(df):
+    """Índice de búsqueda para un DataFrame tipado de DATOS."""
+    indice = {"lock": threading.Lock(), "textos": {}, "gramas": {}}
+    _indexar_busqueda(indice, df)
+    return indice
+
+
+def ajustar_indice_busqueda(indice, quitar, agregar):
+    """
+    Índice nuevo que olvida los textos de `quitar` e indexa `agregar`. El
+    recibido no se modifica (copia al escribir: solo se copian los gramas que cambian).
+    """
+    with indice["lock"]:
+        nuevo = {"lock": threading.Lock(), "textos": dict(indice["textos"]),
+                 "gramas": dict(indice["gramas"])}
+    for posicion in quitar.index.difference(agregar.index):
+        nuevo["textos"].pop(posicion, None)
+    _indexar_busqueda(nuevo, agregar, compartido=True)
+    return nuevo
+
+
+def indice_busqueda(almacen, df):
+    """
+    Índice de búsqueda del DataFrame `df` tal como lo retornó cargar_datos.
+    Se guarda en la instantánea compartida y se construye la primera vez.
+    """
+    entrada = _cache_datos_global()["entradas"].get(almacen.clave)
+    if entrada is None or entrada["df"] is not df:
+        return _nuevo_indice_busqueda(df)
+    if "busqueda" not in entrada:
+        entrada["busqueda"] = _nuevo_indice_busqueda(df)
+    return entrada["busqueda"]
+
+
+def _candidatos(indice, termino):
+    """Posiciones cuyo texto podría contener el término (superconjunto)."""
+    if len(termino) < 3:
+        return set(indice["gramas"].get("^" + termino, ()))
+    postings = [indice["gramas"].get(termino[i:i + 3], set()) for i in range(len(termino) - 2)]
+    return set.intersection(*sorted(postings, key=len))
+
+
+def _puntaje_palabra(texto, termino):
+    """3 si coincide una palabra completa, 2 si es prefijo de una palabra, 1 si está contenido."""
+    palabras = texto.split()
+    if termino in palabras:
+        return 3
+    if any(p.startswith(termino) for p in palabras):
+        return 2
+    return 1 if termino in texto and len(termino) >= 3 else 0
+
+
+def buscar_registros(almacen, df, documento="", nombre=""):
+    """
+    Busca por número de documento y/o nombre (todas las palabras deben
+    coincidir, sin importar tildes). Consultas de 1 o 2 caracteres buscan
+    prefijos de palabra; más largas, cualquier parte del texto.
+    Retorna las posiciones de df ordenadas de mayor a menor relevancia.
+    """
+    indice = indice_busqueda(almacen, df)
+    documento = normalizar_texto(documento).replace(" ", "")
+    terminos = normalizar_texto(nombre).split()
+    with indice["lock"]:
+        consultas = ([documento] if documento else []) + terminos
+        if not consultas:
+            return []
+        candidatos = set.intersection(*(_candidatos(indice, t) for t in consultas))
+        textos = {p: indice["textos"].get(p) for p in candidatos}
+
+    resultados = []
+    for posicion, texto in textos.items():
+        if texto is None:
+            continue
+        texto_nombre, texto_documento = texto
+        puntaje = 0
+        if documento:
+            if texto_documento == documento:
+                puntaje += 100
+            elif texto_documento.startswith(documento):
+                puntaje += 50
+            elif len(documento) >= 3 and documento in texto_documento:
+                puntaje += 10
+            else:
+                continue
+        puntajes = [_puntaje_palabra(texto_nombre, t) for t in terminos]
+        if not all(puntajes):
+            continue
+        resultados.append((-(puntaje + sum(puntajes)), posicion))
+    resultados.sort()
+    return [posicion for _, posicion in resultados]
+
+
 # ============================================================
 # FUNCIÓN: Filtrar datos según rol
 # ============================================================
 
-def filtrar_por_rol(df):
-    """Filtra el DataFrame según el rol del usuario logueado."""
-    if st.session_state.get("rol") == "SECRETARIA":
-        return df
+def filtros_de_rol():
+    """Filtros del motor que restringen los datos al rol del usuario logueado."""
+    if st.session_state.get("rol") == "SECRETARIA":
+        return {}
+    eps_usuario = st.session_state.get("eps_asignada", "")
+    return {"eps_reporta": [eps_usuario]} if eps_usuario else {}
+
+
+def filtrar_por_rol(df):
+    """Filtra el DataFrame según el rol del usuario logueado."""
+    if st.session_state.get("rol") == "SECRETARIA":
+        return df
+    else:
+        eps_usuario = st.session_state.get("eps_asignada", "")
+        if eps_usuario and not df.empty:
+            return df[df["eps_reporta"] == eps_usuario]
+        return df
+
+
+# ============================================================
+# TABLA PAGINADA
+# ============================================================
+
+TAMANOS_PAGINA = [25, 50, 100]
+SIN_ORDEN = "(orden actual)"
+
+
+def tabla_paginada(df, columnas, clave, titulo_conteo="registro(s)"):
+    """
+    Tabla con orden, tamaño de página y proyección de columnas resueltos en el
+    servidor: solo se envía al navegador la página visible.
+    clave: prefijo único para los widgets de la tabla.
+    """
+    columnas = [c for c in columnas if c in df.columns]
+    total = len(df)
+    col1, col2, col3, col4 = st.columns([3, 2, 2, 2])
+    with col1:
+        orden_col = st.selectbox("Ordenar por", options=[SIN_ORDEN] + columnas, key=f"{clave}_orden")
+    with col2:
+        descendente = st.radio("Orden", options=["Asc", "Desc"], horizontal=True,
+                               key=f"{clave}_sentido") == "Desc"
+    with col3:
+        tamano = st.selectbox("Filas por página", options=TAMANOS_PAGINA, key=f"{clave}_tamano")
+    paginas = max(1, -(-total // tamano))
+    clave_pagina = f"{clave}_pagina"
+    # Si los filtros redujeron el total, la página guardada puede quedar fuera de rango
+    if st.session_state.get(clave_pagina, 1) > paginas:
+        st.session_state[clave_pagina] = paginas
+    with col4:
+        pagina = st.number_input("Página", min_value=1, max_value=paginas, step=1, key=clave_pagina)
+
+    # Ordenar solo la columna elegida y tomar las posiciones de la página
+    if orden_col == SIN_ORDEN:
+        orden = pd.RangeIndex(total)[::-1] if descendente else pd.RangeIndex(total)
     else:
-        eps_usuario = st.session_state.get("eps_asignada", "")
-        if eps_usuario and not df.empty:
-            return df[df["eps_reporta"] == eps_usuario]
-        return df
+        orden = df[orden_col].reset_index(drop=True).sort_values(
+            ascending=not descendente, kind="stable", na_position="last").index
+    inicio = (pagina - 1) * tamano
+    posiciones = orden[inicio:inicio + tamano]
+    st.dataframe(df.iloc[posiciones][columnas], use_container_width=True, hide_index=True)
+    st.caption(f"Mostrando {min(inicio + 1, total)}–{min(inicio + tamano, total)} "
+               f"de {total} {titulo_conteo} · página {pagina} de {paginas}")
 
 
 # ============================================================
@@ -518,9 +1999,9 @@ def mostrar_login():
                 if not usuario or not password:
                     st.error("⚠️ Ingrese usuario y contraseña.")
                 else:
-                    spreadsheet = obtener_conexion_gsheets()
-                    if spreadsheet:
-                        valido, datos_usuario = verificar_credenciales(spreadsheet, usuario, password)
+                    almacen = obtener_almacen()
+                    if almacen:
+                        valido, datos_usuario = verificar_credenciales(almacen, usuario, password)
                         if valido:
                             st.session_state["autenticado"] = True
                             st.session_state["usuario"] = datos_usuario["usuario"]
@@ -543,8 +2024,8 @@ def mostrar_login():
 # SIDEBAR (después de login)
 # ============================================================
 
-def mostrar_sidebar():
-    """Configura el sidebar con logo, info de usuario y navegación."""
+def mostrar_sidebar(almacen):
+    """Configura el sidebar con logo, info de usuario, alertas y navegación."""
     with st.sidebar:
         try:
             st.image("Imagen1.png", width=200)
@@ -558,6 +2039,15 @@ def mostrar_sidebar():
             st.markdown(f"🏥 EPS: **{st.session_state.get('eps_asignada', '')}**")
         st.markdown("---")
 
+        # Alertas activas (conteos materializados, sin recorrer los datos)
+        eps_alertas = None if st.session_state.get("rol") == "SECRETARIA" else st.session_state.get("eps_asignada")
+        alertas = conteo_alertas(almacen, cargar_datos(almacen), eps_alertas)
+        st.markdown("**🚨 Alertas activas**")
+        st.markdown(f"🔴 Reincidentes: **{alertas['reincidentes']}**  \n"
+                    f"🟡 Sin seguimiento: **{alertas['sin_seguimiento']}**  \n"
+                    f"🟠 Abandonos: **{alertas['abandonos']}**")
+        st.markdown("---")
+
         # Menú de navegación
         opciones = [
             "📊 Tablero de Control",
@@ -591,7 +2081,7 @@ def mostrar_sidebar():
 # MÓDULO 1: FORMULARIO DE DIGITACIÓN
 # ============================================================
 
-def modulo_formulario(spreadsheet):
+def modulo_formulario(almacen):
     """Formulario de registro de nuevos casos."""
     st.markdown(f"""
     <div class="main-header">
@@ -759,10 +2249,10 @@ def modulo_formulario(spreadsheet):
                 for err in errores:
                     st.error(f"⚠️ {err}")
             else:
-                # Verificar duplicados por número de documento
-                df_check = cargar_datos(spreadsheet, forzar=True)
-                df_check = filtrar_por_rol(df_check)
-                duplicados = buscar_por_documento(df_check, numero_doc)
+                # Verificar duplicados por número de documento (índice sobre la caché
+                # compartida, que ya incluye lo guardado por write-through)
+                df_check = cargar_datos(almacen)
+                duplicados = filtrar_por_rol(buscar_por_documento(almacen, df_check, numero_doc))
                 if not duplicados.empty:
                     st.warning(f"⚠️ Ya existe(n) **{len(duplicados)}** registro(s) con el documento **{numero_doc}**. "
                                "Si desea actualizar el caso existente, use el módulo 'Editar / Actualizar Caso'.")
@@ -814,7 +2304,7 @@ def modulo_formulario(spreadsheet):
                     }
 
                     with st.spinner("Guardando registro..."):
-                        exito, resultado = guardar_registro(spreadsheet, datos)
+                        exito, resultado = guardar_registro(almacen, datos)
 
                     if exito:
                         st.success(f"✅ Registro guardado exitosamente para **{nombres.upper()} {apellidos.upper()}** "
@@ -826,11 +2316,152 @@ def modulo_formulario(spreadsheet):
                         st.error(f"❌ Error al guardar: {resultado}")
 
 
+# ============================================================
+# CACHÉ DE FIGURAS DEL TABLERO
+# ============================================================
+
+MAX_FIGURAS_CACHE = 64
+
+
+@st.cache_resource(show_spinner=False)
+def _cache_figuras():
+    """Figuras de Plotly ya construidas, compartidas por todas las sesiones (LRU)."""
+    return {"lock": threading.Lock(), "figuras": OrderedDict()}
+
+
+def clave_vista(almacen, df, *filtros):
+    """
+    Clave de una vista del tablero: versión de la instantánea de DATOS, rol del
+    usuario y hash de los filtros activos. None si `df` no es la instantánea
+    compartida (p. ej. tras un error de carga), en cuyo caso no se memoriza.
+    """
+    entrada = _cache_datos_global()["entradas"].get(almacen.clave)
+    if entrada is None or entrada["df"] is not df:
+        return None
+    estado = json.dumps([filtros_de_rol(), *filtros], sort_keys=True, default=str)
+    return (almacen.clave, entrada["version"], hashlib.sha1(estado.encode()).hexdigest())
+
+
+def figura_memorizada(vista, nombre, construir):
+    """
+    Retorna la figura `nombre` de la vista; la construye con construir() si no
+    está. La misma figura se entrega a todas las sesiones: st.plotly_chart solo
+    la lee, y quien la reciba no debe modificarla.
+    """
+    if vista is None:
+        return construir()
+    cache = _cache_figuras()
+    clave = (*vista, nombre)
+    with cache["lock"]:
+        figura = cache["figuras"].get(clave)
+        if figura is not None:
+            cache["figuras"].move_to_end(clave)
+            return figura
+    figura = construir()
+    with cache["lock"]:
+        cache["figuras"][clave] = figura
+        while len(cache["figuras"]) > MAX_FIGURAS_CACHE:
+            cache["figuras"].popitem(last=False)
+    return figura
+
+
+def _figura_municipios(cubo):
+    """Barras horizontales de casos por municipio."""
+    df_mun = contar_por(cubo, "municipio_residencia").reset_index()
+    df_mun.columns = ["Municipio", "Casos"]
+    df_mun["Porcentaje"] = (df_mun["Casos"] / df_mun["Casos"].sum() * 100).round(1)
+    df_mun = df_mun.sort_values("Casos", ascending=True)
+    fig_mun = px.bar(df_mun, x="Casos", y="Municipio", orientation="h",
+                     title="Casos por Municipio",
+                     color="Casos", color_continuous_scale="Reds",
+                     text="Casos", custom_data=["Porcentaje"])
+    fig_mun.update_traces(textposition="outside",
+                          hovertemplate="<b>%{y}</b><br>Casos: %{x}<br>Porcentaje: %{customdata[0]}%<extra></extra>")
+    fig_mun.update_layout(height=max(400, len(df_mun) * 28), showlegend=False,
+                          coloraxis_showscale=False)
+    return fig_mun
+
+
+def _figura_eps(cubo):
+    """Barras de casos por EPS."""
+    df_eps = contar_por(cubo, "eps_reporta").reset_index()
+    df_eps.columns = ["EPS", "Casos"]
+    df_eps["Porcentaje"] = (df_eps["Casos"] / df_eps["Casos"].sum() * 100).round(1)
+    fig_eps = px.bar(df_eps, x="EPS", y="Casos",
+                     title="Casos por EPS",
+                     color="Casos", color_continuous_scale="Blues",
+                     text="Casos", custom_data=["Porcentaje"])
+    fig_eps.update_traces(textposition="outside",
+                          hovertemplate="<b>%{x}</b><br>Casos: %{y}<br>Porcentaje: %{customdata[0]}%<extra></extra>")
+    fig_eps.update_layout(xaxis_tickangle=-45, height=400, showlegend=False,
+                          coloraxis_showscale=False)
+    return fig_eps
+
+
+def _figura_ciclo(cubo):
+    """Torta de casos por curso de vida."""
+    df_ciclo = contar_por(cubo, "ciclo_vital").reset_index()
+    df_ciclo.columns = ["Curso de Vida", "Casos"]
+    fig_ciclo = px.pie(df_ciclo, values="Casos", names="Curso de Vida",
+                       title="Distribución por Curso de Vida",
+                       color_discrete_sequence=["#0D2137", "#1B3A5C", "#2E6B9E", "#4A90C4", "#7FB3D8", "#B5D4E9"],
+                       hole=0.4)
+    fig_ciclo.update_traces(textinfo="percent+value")
+    return fig_ciclo
+
+
+def _figura_sexo(cubo):
+    """Torta de casos por sexo."""
+    df_sexo = contar_por(cubo, "sexo").reset_index()
+    df_sexo.columns = ["Sexo", "Casos"]
+    fig_sexo = px.pie(df_sexo, values="Casos", names="Sexo",
+                      title="Distribución por Sexo",
+                      color_discrete_sequence=["#D32F2F", "#1565C0", "#9E9E9E"],
+                      hole=0.4)
+    fig_sexo.update_traces(textinfo="percent+value")
+    return fig_sexo
+
+
+def _figura_semanas(cubo):
+    """Línea de casos por semana epidemiológica."""
+    df_sem = cubo.groupby("semana_epidemiologica")["casos"].sum().reset_index(name="Casos")
+    fig_sem = px.line(df_sem, x="semana_epidemiologica", y="Casos",
+                      title="Tendencia de Casos por Semana Epidemiológica",
+                      markers=True, text="Casos")
+    fig_sem.update_traces(textposition="top center",
+                          line_color=COLOR_AZUL_OSCURO, marker_color=COLOR_ROJO_ALERTA)
+    fig_sem.update_layout(xaxis_title="Semana Epidemiológica", yaxis_title="Número de Casos")
+    return fig_sem
+
+
+def _figura_estados(cubo):
+    """Barras de casos por estado del caso."""
+    df_estado = contar_por(cubo, "estado_caso").reset_index()
+    df_estado.columns = ["Estado", "Casos"]
+    df_estado["Porcentaje"] = (df_estado["Casos"] / df_estado["Casos"].sum() * 100).round(1)
+    fig_estado = px.bar(df_estado, x="Estado", y="Casos",
+                        title="Distribución por Estado del Caso",
+                        color="Estado",
+                        text="Casos", custom_data=["Porcentaje"],
+                        color_discrete_map={
+                            "ACTIVO": "#F9A825",
+                            "CERRADO": "#4CAF50",
+                            "EN SEGUIMIENTO": "#2196F3",
+                            "FALLECIDO": "#D32F2F",
+                            "SIN CONTACTO": "#9E9E9E",
+                            "REMITIDO A OTRA EPS": "#FF9800"
+                        })
+    fig_estado.update_traces(textposition="outside",
+                             hovertemplate="<b>%{x}</b><br>Casos: %{y}<br>Porcentaje: %{customdata[0]}%<extra></extra>")
+    fig_estado.update_layout(showlegend=False)
+    return fig_estado
+
+
 # ============================================================
 # MÓDULO 2: TABLERO DE CONTROL (DASHBOARD)
 # ============================================================
 
-def modulo_dashboard(spreadsheet):
+def modulo_dashboard(almacen):
     """Tablero de control con KPIs, gráficas y alertas."""
     st.markdown(f"""
     <div class="main-header">
@@ -840,39 +2471,44 @@ def modulo_dashboard(spreadsheet):
     """, unsafe_allow_html=True)
 
     # Cargar y filtrar datos
-    df = cargar_datos(spreadsheet, forzar=False)
-    df = filtrar_por_rol(df)
+    df = cargar_datos(almacen, forzar=False)
+    cubo = filtrar_por_rol(cubo_datos(almacen, df))
 
-    if df.empty:
+    if cubo.empty:
         st.info("📭 No hay datos registrados aún. Comience registrando casos en el módulo de Digitación.")
         return
 
-    # Convertir tipos
-    df["edad"] = pd.to_numeric(df["edad"], errors="coerce").fillna(0).astype(int)
-    df["num_seguimientos_realizados"] = pd.to_numeric(
-        df["num_seguimientos_realizados"], errors="coerce").fillna(0).astype(int)
-    df["semana_epidemiologica"] = pd.to_numeric(
-        df["semana_epidemiologica"], errors="coerce").fillna(0).astype(int)
+    _panel_tablero(almacen, df, cubo)
+
+
+@st.fragment
+def _panel_tablero(almacen, df, cubo):
+    """
+    Filtros, KPIs y vistas del tablero. Al cambiar un filtro solo se re-ejecuta
+    este fragmento, sin recargar conexión, sidebar ni datos.
+    """
+    motor = motor_filtros(almacen, df)
 
     # --- Filtros ---
     with st.expander("🔽 Filtros", expanded=False):
         col1, col2, col3, col4 = st.columns(4)
         with col1:
-            filtro_eps = st.multiselect("EPS", options=sorted(df["eps_reporta"].unique().tolist()))
+            filtro_eps = st.multiselect("EPS", options=sorted(cubo["eps_reporta"].unique().tolist()))
         with col2:
-            filtro_municipio = st.multiselect("Municipio", options=sorted(df["municipio_residencia"].unique().tolist()))
+            filtro_municipio = st.multiselect("Municipio", options=sorted(cubo["municipio_residencia"].unique().tolist()))
         with col3:
-            filtro_ciclo = st.multiselect("Curso de vida", options=sorted(df["ciclo_vital"].unique().tolist()))
+            filtro_ciclo = st.multiselect("Curso de vida", options=sorted(cubo["ciclo_vital"].unique().tolist()))
         with col4:
-            filtro_estado = st.multiselect("Estado del caso", options=sorted(df["estado_caso"].unique().tolist()))
+            filtro_estado = st.multiselect("Estado del caso", options=sorted(cubo["estado_caso"].unique().tolist()))
 
         col1, col2 = st.columns(2)
         with col1:
             try:
-                fechas_validas = pd.to_datetime(df["fecha_notificacion_sivigila"], errors="coerce").dropna()
-                if not fechas_validas.empty:
-                    fecha_min = fechas_validas.min().date()
-                    fecha_max = fechas_validas.max().date()
+                fechas_validas = motor["fechas"][mascara_filtros(motor, filtros_de_rol())]
+                fechas_validas = fechas_validas[~np.isnat(fechas_validas)]
+                if len(fechas_validas):
+                    fecha_min = pd.Timestamp(fechas_validas.min()).date()
+                    fecha_max = pd.Timestamp(fechas_validas.max()).date()
                     filtro_fecha = st.date_input("Rango de fechas de notificación",
                                                  value=(fecha_min, fecha_max),
                                                  min_value=fecha_min, max_value=fecha_max)
@@ -881,33 +2517,22 @@ def modulo_dashboard(spreadsheet):
             except:
                 filtro_fecha = None
 
-    # Aplicar filtros
-    df_filtrado = df.copy()
-    if filtro_eps:
-        df_filtrado = df_filtrado[df_filtrado["eps_reporta"].isin(filtro_eps)]
-    if filtro_municipio:
-        df_filtrado = df_filtrado[df_filtrado["municipio_residencia"].isin(filtro_municipio)]
-    if filtro_ciclo:
-        df_filtrado = df_filtrado[df_filtrado["ciclo_vital"].isin(filtro_ciclo)]
-    if filtro_estado:
-        df_filtrado = df_filtrado[df_filtrado["estado_caso"].isin(filtro_estado)]
-    if filtro_fecha and isinstance(filtro_fecha, tuple) and len(filtro_fecha) == 2:
-        df_filtrado["_fecha_temp"] = pd.to_datetime(df_filtrado["fecha_notificacion_sivigila"], errors="coerce")
-        df_filtrado = df_filtrado[
-            (df_filtrado["_fecha_temp"] >= pd.Timestamp(filtro_fecha[0])) &
-            (df_filtrado["_fecha_temp"] <= pd.Timestamp(filtro_fecha[1]))
-        ]
-        df_filtrado = df_filtrado.drop(columns=["_fecha_temp"], errors="ignore")
+    # Aplicar filtros: KPIs y gráficas salen del cubo
+    filtros = {
+        "eps_reporta": filtro_eps,
+        "municipio_residencia": filtro_municipio,
+        "ciclo_vital": filtro_ciclo,
+        "estado_caso": filtro_estado,
+    }
+    cubo_filtrado = filtrar_cubo(filtrar_por_rol(cubo_del_rango(cubo, motor, filtro_fecha)), filtros)
+    totales = cubo_filtrado[MEDIDAS_CUBO].sum()
 
     # --- KPIs ---
-    total_casos = len(df_filtrado)
-    reincidentes = len(df_filtrado[df_filtrado["intento_previo"].str.upper() == "SI"])
+    total_casos = int(totales["casos"])
+    reincidentes = int(totales["reincidentes"])
     pct_reincidentes = (reincidentes / total_casos * 100) if total_casos > 0 else 0
-    menores_18 = len(df_filtrado[df_filtrado["edad"] < 18])
-    activos_sin_seg = len(df_filtrado[
-        (df_filtrado["estado_caso"].str.upper() == "ACTIVO") &
-        (df_filtrado["num_seguimientos_realizados"] == 0)
-    ])
+    menores_18 = int(totales["menores_18"])
+    activos_sin_seg = int(totales["activos_sin_seg"])
 
     col1, col2, col3, col4 = st.columns(4)
     with col1:
@@ -937,167 +2562,129 @@ def modulo_dashboard(spreadsheet):
 
     st.markdown("<br>", unsafe_allow_html=True)
 
-    # --- Gráficas ---
-    tab1, tab2, tab3 = st.tabs(["📊 Distribución", "📈 Tendencias", "🚨 Alertas"])
+    # --- Gráficas y alertas: solo se calcula la vista seleccionada ---
+    _vistas_tablero(almacen, df, cubo_filtrado, filtros, filtro_fecha, total_casos)
 
-    with tab1:
-        col1, col2 = st.columns(2)
 
-        with col1:
-            # Casos por municipio
-            if not df_filtrado.empty:
-                df_mun = df_filtrado["municipio_residencia"].value_counts().reset_index()
-                df_mun.columns = ["Municipio", "Casos"]
-                df_mun["Porcentaje"] = (df_mun["Casos"] / df_mun["Casos"].sum() * 100).round(1)
-                df_mun = df_mun.sort_values("Casos", ascending=True)
-                fig_mun = px.bar(df_mun, x="Casos", y="Municipio", orientation="h",
-                                 title="Casos por Municipio",
-                                 color="Casos", color_continuous_scale="Reds",
-                                 text="Casos", custom_data=["Porcentaje"])
-                fig_mun.update_traces(textposition="outside",
-                                      hovertemplate="<b>%{y}</b><br>Casos: %{x}<br>Porcentaje: %{customdata[0]}%<extra></extra>")
-                fig_mun.update_layout(height=max(400, len(df_mun) * 28), showlegend=False,
-                                      coloraxis_showscale=False)
-                st.plotly_chart(fig_mun, use_container_width=True)
+VISTAS_TABLERO = ["📊 Distribución", "📈 Tendencias", "🚨 Alertas"]
 
-        with col2:
-            # Casos por EPS
-            if not df_filtrado.empty:
-                df_eps = df_filtrado["eps_reporta"].value_counts().reset_index()
-                df_eps.columns = ["EPS", "Casos"]
-                df_eps["Porcentaje"] = (df_eps["Casos"] / df_eps["Casos"].sum() * 100).round(1)
-                fig_eps = px.bar(df_eps, x="EPS", y="Casos",
-                                 title="Casos por EPS",
-                                 color="Casos", color_continuous_scale="Blues",
-                                 text="Casos", custom_data=["Porcentaje"])
-                fig_eps.update_traces(textposition="outside",
-                                      hovertemplate="<b>%{x}</b><br>Casos: %{y}<br>Porcentaje: %{customdata[0]}%<extra></extra>")
-                fig_eps.update_layout(xaxis_tickangle=-45, height=400, showlegend=False,
-                                      coloraxis_showscale=False)
-                st.plotly_chart(fig_eps, use_container_width=True)
 
-        col1, col2 = st.columns(2)
+@st.fragment
+def _vistas_tablero(almacen, df, cubo_filtrado, filtros, filtro_fecha, total_casos):
+    """
+    Selector de vista del tablero. A diferencia de st.tabs, solo se construye la
+    vista elegida, y cambiar de vista re-ejecuta únicamente este fragmento.
+    """
+    seleccion = st.radio("Vista", VISTAS_TABLERO, horizontal=True,
+                         label_visibility="collapsed", key="tablero_vista")
+    if seleccion == "🚨 Alertas":
+        _vista_alertas(almacen, df, filtros, filtro_fecha)
+    elif total_casos > 0:
+        # Figuras memorizadas por versión de datos y filtros
+        vista = clave_vista(almacen, df, filtros, filtro_fecha)
+        if seleccion == "📊 Distribución":
+            _vista_distribucion(vista, cubo_filtrado)
+        else:
+            _vista_tendencias(vista, cubo_filtrado)
 
-        with col1:
-            # Distribución por curso de vida
-            if not df_filtrado.empty:
-                df_ciclo = df_filtrado["ciclo_vital"].value_counts().reset_index()
-                df_ciclo.columns = ["Curso de Vida", "Casos"]
-                fig_ciclo = px.pie(df_ciclo, values="Casos", names="Curso de Vida",
-                                   title="Distribución por Curso de Vida",
-                                   color_discrete_sequence=["#0D2137", "#1B3A5C", "#2E6B9E", "#4A90C4", "#7FB3D8", "#B5D4E9"],
-                                   hole=0.4)
-                fig_ciclo.update_traces(textinfo="percent+value")
-                st.plotly_chart(fig_ciclo, use_container_width=True)
 
-        with col2:
-            # Distribución por sexo
-            if not df_filtrado.empty:
-                df_sexo = df_filtrado["sexo"].value_counts().reset_index()
-                df_sexo.columns = ["Sexo", "Casos"]
-                fig_sexo = px.pie(df_sexo, values="Casos", names="Sexo",
-                                  title="Distribución por Sexo",
-                                  color_discrete_sequence=["#D32F2F", "#1565C0", "#9E9E9E"],
-                                  hole=0.4)
-                fig_sexo.update_traces(textinfo="percent+value")
-                st.plotly_chart(fig_sexo, use_container_width=True)
-
-    with tab2:
-        # Tendencia por semana epidemiológica
-        if not df_filtrado.empty:
-            df_sem = df_filtrado.groupby("semana_epidemiologica").size().reset_index(name="Casos")
-            df_sem = df_sem.sort_values("semana_epidemiologica")
-            fig_sem = px.line(df_sem, x="semana_epidemiologica", y="Casos",
-                              title="Tendencia de Casos por Semana Epidemiológica",
-                              markers=True, text="Casos")
-            fig_sem.update_traces(textposition="top center",
-                                  line_color=COLOR_AZUL_OSCURO, marker_color=COLOR_ROJO_ALERTA)
-            fig_sem.update_layout(xaxis_title="Semana Epidemiológica", yaxis_title="Número de Casos")
-            st.plotly_chart(fig_sem, use_container_width=True)
-
-        # Casos por estado
-        if not df_filtrado.empty:
-            df_estado = df_filtrado["estado_caso"].value_counts().reset_index()
-            df_estado.columns = ["Estado", "Casos"]
-            df_estado["Porcentaje"] = (df_estado["Casos"] / df_estado["Casos"].sum() * 100).round(1)
-            fig_estado = px.bar(df_estado, x="Estado", y="Casos",
-                                title="Distribución por Estado del Caso",
-                                color="Estado",
-                                text="Casos", custom_data=["Porcentaje"],
-                                color_discrete_map={
-                                    "ACTIVO": "#F9A825",
-                                    "CERRADO": "#4CAF50",
-                                    "EN SEGUIMIENTO": "#2196F3",
-                                    "FALLECIDO": "#D32F2F",
-                                    "SIN CONTACTO": "#9E9E9E",
-                                    "REMITIDO A OTRA EPS": "#FF9800"
-                                })
-            fig_estado.update_traces(textposition="outside",
-                                     hovertemplate="<b>%{x}</b><br>Casos: %{y}<br>Porcentaje: %{customdata[0]}%<extra></extra>")
-            fig_estado.update_layout(showlegend=False)
-            st.plotly_chart(fig_estado, use_container_width=True)
-
-    with tab3:
-        # --- Tabla: Alerta Roja - Reincidentes ---
-        st.markdown("""
-        <div class="alerta-roja">
-            <strong>🚨 ALERTA ROJA — Pacientes con intento previo (Reincidentes)</strong>
-        </div>
-        """, unsafe_allow_html=True)
-        df_reincidentes = df_filtrado[df_filtrado["intento_previo"].str.upper() == "SI"]
-        if not df_reincidentes.empty:
-            cols_alerta = ["numero_documento", "nombres", "apellidos", "municipio_residencia",
-                           "edad", "eps_reporta", "fecha_notificacion_sivigila", "estado_caso"]
-            cols_disp = [c for c in cols_alerta if c in df_reincidentes.columns]
-            st.dataframe(df_reincidentes[cols_disp], use_container_width=True, hide_index=True)
-        else:
-            st.info("No se encontraron pacientes reincidentes con los filtros actuales.")
+def _vista_distribucion(vista, cubo_filtrado):
+    """Gráficas de distribución por municipio, EPS, curso de vida y sexo."""
+    col1, col2 = st.columns(2)
 
-        st.markdown("<br>", unsafe_allow_html=True)
+    with col1:
+        # Casos por municipio
+        st.plotly_chart(figura_memorizada(vista, "municipio", lambda: _figura_municipios(cubo_filtrado)),
+                        use_container_width=True)
 
-        # --- Tabla: Alerta Amarilla - Sin seguimiento ---
-        st.markdown("""
-        <div class="alerta-amarilla">
-            <strong>⚠️ ALERTA AMARILLA — Pacientes activos sin seguimiento o sin contacto</strong>
-        </div>
-        """, unsafe_allow_html=True)
-        df_sin_seg = df_filtrado[
-            ((df_filtrado["estado_caso"].str.upper() == "ACTIVO") &
-             (df_filtrado["num_seguimientos_realizados"] == 0)) |
-            (df_filtrado["asiste_servicios"].str.upper().isin(["NO", "SIN CONTACTO"]))
-        ]
-        if not df_sin_seg.empty:
-            cols_alerta2 = ["numero_documento", "nombres", "apellidos", "municipio_residencia",
-                            "edad", "eps_reporta", "asiste_servicios", "num_seguimientos_realizados",
-                            "estado_caso"]
-            cols_disp2 = [c for c in cols_alerta2 if c in df_sin_seg.columns]
-            st.dataframe(df_sin_seg[cols_disp2], use_container_width=True, hide_index=True)
-        else:
-            st.info("No se encontraron pacientes sin seguimiento con los filtros actuales.")
+    with col2:
+        # Casos por EPS
+        st.plotly_chart(figura_memorizada(vista, "eps", lambda: _figura_eps(cubo_filtrado)),
+                        use_container_width=True)
 
-        st.markdown("<br>", unsafe_allow_html=True)
+    col1, col2 = st.columns(2)
 
-        # --- Tabla: Alerta - Abandonos ---
-        st.markdown("""
-        <div class="alerta-amarilla">
-            <strong>⚠️ ALERTA — Pacientes que abandonaron tratamiento</strong>
-        </div>
-        """, unsafe_allow_html=True)
-        df_abandono = df_filtrado[df_filtrado["abandono_tratamiento"].str.upper() == "SI"]
-        if not df_abandono.empty:
-            cols_alerta3 = ["numero_documento", "nombres", "apellidos", "municipio_residencia",
-                            "edad", "eps_reporta", "estado_caso"]
-            cols_disp3 = [c for c in cols_alerta3 if c in df_abandono.columns]
-            st.dataframe(df_abandono[cols_disp3], use_container_width=True, hide_index=True)
-        else:
-            st.info("No se encontraron pacientes que hayan abandonado tratamiento.")
+    with col1:
+        # Distribución por curso de vida
+        st.plotly_chart(figura_memorizada(vista, "ciclo", lambda: _figura_ciclo(cubo_filtrado)),
+                        use_container_width=True)
+
+    with col2:
+        # Distribución por sexo
+        st.plotly_chart(figura_memorizada(vista, "sexo", lambda: _figura_sexo(cubo_filtrado)),
+                        use_container_width=True)
+
+
+def _vista_tendencias(vista, cubo_filtrado):
+    """Tendencia semanal y distribución por estado del caso."""
+    # Tendencia por semana epidemiológica
+    st.plotly_chart(figura_memorizada(vista, "semana", lambda: _figura_semanas(cubo_filtrado)),
+                    use_container_width=True)
+
+    # Casos por estado
+    st.plotly_chart(figura_memorizada(vista, "estado", lambda: _figura_estados(cubo_filtrado)),
+                    use_container_width=True)
+
+
+def _vista_alertas(almacen, df, filtros, filtro_fecha):
+    """Tablas de alerta: reincidentes, sin seguimiento y abandonos."""
+    # Las tablas de alerta necesitan los registros, no solo los conteos
+    motor = motor_filtros(almacen, df)
+    mascara = mascara_filtros(motor, {**filtros, **filtros_de_rol()}, filtro_fecha)
+
+    # --- Tabla: Alerta Roja - Reincidentes ---
+    st.markdown("""
+    <div class="alerta-roja">
+        <strong>🚨 ALERTA ROJA — Pacientes con intento previo (Reincidentes)</strong>
+    </div>
+    """, unsafe_allow_html=True)
+    df_reincidentes = df[mascara & mascara_alerta(almacen, df, "reincidentes")]
+    if not df_reincidentes.empty:
+        cols_alerta = ["numero_documento", "nombres", "apellidos", "municipio_residencia",
+                       "edad", "eps_reporta", "fecha_notificacion_sivigila", "estado_caso"]
+        tabla_paginada(df_reincidentes, cols_alerta, "alerta_roja", "pacientes")
+    else:
+        st.info("No se encontraron pacientes reincidentes con los filtros actuales.")
+
+    st.markdown("<br>", unsafe_allow_html=True)
+
+    # --- Tabla: Alerta Amarilla - Sin seguimiento ---
+    st.markdown("""
+    <div class="alerta-amarilla">
+        <strong>⚠️ ALERTA AMARILLA — Pacientes activos sin seguimiento o sin contacto</strong>
+    </div>
+    """, unsafe_allow_html=True)
+    df_sin_seg = df[mascara & mascara_alerta(almacen, df, "sin_seguimiento")]
+    if not df_sin_seg.empty:
+        cols_alerta2 = ["numero_documento", "nombres", "apellidos", "municipio_residencia",
+                        "edad", "eps_reporta", "asiste_servicios", "num_seguimientos_realizados",
+                        "estado_caso"]
+        tabla_paginada(df_sin_seg, cols_alerta2, "alerta_amarilla", "pacientes")
+    else:
+        st.info("No se encontraron pacientes sin seguimiento con los filtros actuales.")
+
+    st.markdown("<br>", unsafe_allow_html=True)
+
+    # --- Tabla: Alerta - Abandonos ---
+    st.markdown("""
+    <div class="alerta-amarilla">
+        <strong>⚠️ ALERTA — Pacientes que abandonaron tratamiento</strong>
+    </div>
+    """, unsafe_allow_html=True)
+    df_abandono = df[mascara & mascara_alerta(almacen, df, "abandonos")]
+    if not df_abandono.empty:
+        cols_alerta3 = ["numero_documento", "nombres", "apellidos", "municipio_residencia",
+                        "edad", "eps_reporta", "estado_caso"]
+        tabla_paginada(df_abandono, cols_alerta3, "alerta_abandono", "pacientes")
+    else:
+        st.info("No se encontraron pacientes que hayan abandonado tratamiento.")
 
 
 # ============================================================
 # MÓDULO 3: EDICIÓN Y ACTUALIZACIÓN DE CASOS
 # ============================================================
 
-def modulo_edicion(spreadsheet):
+def modulo_edicion(almacen):
     """Módulo para buscar, ver y editar registros existentes."""
     st.markdown(f"""
     <div class="main-header">
@@ -1106,8 +2693,18 @@ def modulo_edicion(spreadsheet):
     </div>
     """, unsafe_allow_html=True)
 
-    df = cargar_datos(spreadsheet, forzar=True)
-    df = filtrar_por_rol(df)
+    _panel_edicion(almacen)
+
+
+@st.fragment
+def _panel_edicion(almacen):
+    """
+    Búsqueda, selección y formulario de edición. Escribir en los buscadores o
+    guardar solo re-ejecuta este fragmento; los datos salen de la caché
+    compartida, que ya refleja las ediciones propias (write-through).
+    """
+    df_datos = cargar_datos(almacen)
+    df = filtrar_registros(motor_filtros(almacen, df_datos), filtros_de_rol())
 
     if df.empty:
         st.info("📭 No hay registros disponibles para editar.")
@@ -1121,15 +2718,12 @@ def modulo_edicion(spreadsheet):
     with col2:
         busq_nombre = st.text_input("Buscar por nombre o apellido", key="edit_busq_nombre")
 
-    df_resultado = df.copy()
-    if busq_doc:
-        df_resultado = df_resultado[df_resultado["numero_documento"].astype(str).str.contains(busq_doc, na=False)]
-    if busq_nombre:
-        busq_upper = busq_nombre.upper()
-        df_resultado = df_resultado[
-            df_resultado["nombres"].astype(str).str.upper().str.contains(busq_upper, na=False) |
-            df_resultado["apellidos"].astype(str).str.upper().str.contains(busq_upper, na=False)
-        ]
+    if busq_doc.strip() or busq_nombre.strip():
+        # Resultados del índice, ordenados por relevancia y restringidos al rol
+        posiciones = buscar_registros(almacen, df_datos, busq_doc, busq_nombre)
+        df_resultado = df.loc[[p for p in posiciones if p in df.index]]
+    else:
+        df_resultado = df
 
     if df_resultado.empty:
         st.warning("No se encontraron registros con los criterios de búsqueda.")
@@ -1139,8 +2733,7 @@ def modulo_edicion(spreadsheet):
     st.markdown(f"**{len(df_resultado)} registro(s) encontrado(s)**")
     cols_tabla = ["id", "nombres", "apellidos", "numero_documento", "eps_reporta",
                   "municipio_residencia", "edad", "estado_caso", "fecha_notificacion_sivigila"]
-    cols_disp = [c for c in cols_tabla if c in df_resultado.columns]
-    st.dataframe(df_resultado[cols_disp], use_container_width=True, hide_index=True)
+    tabla_paginada(df_resultado, cols_tabla, "edicion_resultados")
 
     # Seleccionar registro para editar
     ids_disponibles = df_resultado["id"].tolist()
@@ -1167,9 +2760,11 @@ def modulo_edicion(spreadsheet):
                                         index=EPS_LISTA.index(registro.get("eps_reporta", ""))
                                         if registro.get("eps_reporta", "") in EPS_LISTA else 0)
                 semana_edit = st.number_input("Semana epidemiológica", min_value=1, max_value=53,
-                                              value=int(registro.get("semana_epidemiologica", 1) or 1))
+                                              value=entero_o_none(registro.get("semana_epidemiologica")) or None)
             with col2:
-                ciclo_edit = calcular_curso_vida(int(registro.get("edad", 0) or 0))
+                edad_registro = entero_o_none(registro.get("edad"))
+                ciclo_edit = (calcular_curso_vida(edad_registro) if edad_registro is not None
+                              else valor_a_celda("ciclo_vital", registro.get("ciclo_vital")))
                 st.text_input("Curso de vida (automático)", value=ciclo_edit, disabled=True, key=f"edit_ciclo{ks}")
                 intento_edit = st.radio("¿Intento previo?",
                                         options=["NO", "SI"],
@@ -1185,7 +2780,7 @@ def modulo_edicion(spreadsheet):
                                              index=TIPOS_DOCUMENTO.index(registro.get("tipo_documento", "CC"))
                                              if registro.get("tipo_documento", "") in TIPOS_DOCUMENTO else 0)
                 edad_edit = st.number_input("Edad", min_value=0, max_value=120,
-                                            value=int(registro.get("edad", 0) or 0), key=f"edit_edad{ks}")
+                                            value=edad_registro, key=f"edit_edad{ks}")
             with col2:
                 apellidos_edit = st.text_input("Apellidos", value=registro.get("apellidos", ""), key=f"edit_apellidos{ks}")
                 num_doc_edit = st.text_input("Número de documento",
@@ -1207,7 +2802,7 @@ def modulo_edicion(spreadsheet):
             with col1:
                 def parse_date_safe(val):
                     try:
-                        if val and str(val).strip() and str(val).strip() != "None":
+                        if pd.notna(val) and str(val).strip():
                             return pd.to_datetime(val).date()
                     except:
                         pass
@@ -1287,7 +2882,7 @@ def modulo_edicion(spreadsheet):
                                                         registro.get("fecha_seguimiento_postalta")),
                                                     key=f"edit_fecha_segpost{ks}")
                 num_seg_edit = st.number_input("Nº seguimientos realizados", min_value=0, max_value=50,
-                                               value=int(registro.get("num_seguimientos_realizados", 0) or 0),
+                                               value=entero_o_none(registro.get("num_seguimientos_realizados")),
                                                key=f"edit_num_seg{ks}")
                 abandono_edit = st.selectbox("¿Abandonó tratamiento?", options=abandono_opts,
                                              index=abandono_opts.index(registro.get("abandono_tratamiento", "NO"))
@@ -1353,14 +2948,14 @@ def modulo_edicion(spreadsheet):
                     "fecha_digitacion": registro.get("fecha_digitacion", ""),
                     "funcionario_reporta": registro.get("funcionario_reporta", ""),
                     "eps_reporta": eps_edit,
-                    "semana_epidemiologica": str(semana_edit),
-                    "ciclo_vital": calcular_curso_vida(edad_edit),
+                    "semana_epidemiologica": "" if semana_edit is None else str(semana_edit),
+                    "ciclo_vital": calcular_curso_vida(edad_edit) if edad_edit is not None else ciclo_edit,
                     "intento_previo": intento_edit,
                     "nombres": nombres_edit.upper().strip(),
                     "apellidos": apellidos_edit.upper().strip(),
                     "tipo_documento": tipo_doc_edit,
                     "numero_documento": num_doc_edit.strip(),
-                    "edad": str(edad_edit),
+                    "edad": "" if edad_edit is None else str(edad_edit),
                     "sexo": sexo_edit,
                     "municipio_residencia": municipio_edit,
                     "fecha_notificacion_sivigila": str(fecha_notif_edit) if fecha_notif_edit else "",
@@ -1378,7 +2973,7 @@ def modulo_edicion(spreadsheet):
                     "asiste_servicios": asiste_edit,
                     "seguimiento_7dias_postalta": seg7_edit,
                     "fecha_seguimiento_postalta": str(fecha_segpost_edit) if fecha_segpost_edit else "",
-                    "num_seguimientos_realizados": str(num_seg_edit),
+                    "num_seguimientos_realizados": "" if num_seg_edit is None else str(num_seg_edit),
                     "abandono_tratamiento": abandono_edit,
                     "reintento_posterior": reintento_edit,
                     "estado_caso": estado_edit,
@@ -1393,32 +2988,355 @@ def modulo_edicion(spreadsheet):
 
                 with st.spinner("Actualizando registro..."):
                     exito, msg = actualizar_registro(
-                        spreadsheet, id_seleccionado, datos_actualizados,
-                        st.session_state.get("nombre_completo", "")
+                        almacen, id_seleccionado, datos_actualizados,
+                        st.session_state.get("nombre_completo", ""), original=registro
                     )
 
-                if exito:
+                if exito and msg.startswith("Sin cambios"):
+                    st.info(f"ℹ️ {msg}")
+                elif exito:
                     st.success(f"✅ Registro actualizado exitosamente para "
                                f"**{nombres_edit.upper()} {apellidos_edit.upper()}**")
                 else:
                     st.error(f"❌ Error al actualizar: {msg}")
 
 
+# ============================================================
+# GENERACIÓN Y CACHÉ DE EXPORTACIONES
+# ============================================================
+
+MAX_BYTES_EXPORTACIONES = 256 * 1024 * 1024  # tamaño total de archivos en caché
+
+
+@st.cache_resource(show_spinner=False)
+def _cache_exportaciones():
+    """Archivos de exportación ya generados, compartidos por todas las sesiones (LRU por tamaño)."""
+    return {"lock": threading.Lock(), "archivos": OrderedDict(), "bytes": 0}
+
+
+def exportacion_memorizada(vista, formato, generar):
+    """
+    Retorna los bytes del archivo `formato` para la vista (ver clave_vista);
+    lo genera con generar() si no está. Descarta los menos usados cuando el
+    total supera MAX_BYTES_EXPORTACIONES.
+    """
+    if vista is None:
+        return generar()
+    cache = _cache_exportaciones()
+    clave = (*vista, formato)
+    with cache["lock"]:
+        datos = cache["archivos"].get(clave)
+        if datos is not None:
+            cache["archivos"].move_to_end(clave)
+            return datos
+    datos = generar()
+    with cache["lock"]:
+        if clave not in cache["archivos"] and len(datos) <= MAX_BYTES_EXPORTACIONES:
+            cache["archivos"][clave] = datos
+            cache["bytes"] += len(datos)
+            while cache["bytes"] > MAX_BYTES_EXPORTACIONES:
+                _, descartado = cache["archivos"].popitem(last=False)
+                cache["bytes"] -= len(descartado)
+    return datos
+
+
+def generar_csv(df):
+    """CSV (UTF-8 con BOM, para Excel) de los registros."""
+    return df.to_csv(index=False).encode("utf-8-sig")
+
+
+FILAS_POR_BLOQUE_XLSX = 5000
+
+
+def generar_xlsx(df):
+    """
+    Excel con todos los registros y una hoja por curso de vida.
+    Se escribe en una sola pasada con el modo write-only de openpyxl (las hojas
+    van a disco a medida que se agregan filas) y el libro se arma en un archivo
+    temporal, así la memoria no crece con el tamaño de la exportación.
+    """
+    libro = Workbook(write_only=True)
+    hoja_todos = libro.create_sheet("TODOS_LOS_DATOS")
+    presentes = set(df["ciclo_vital"].astype(str).unique())
+    # Max 31 chars para nombre de hoja
+    hojas_ciclo = {ciclo: libro.create_sheet(ciclo.split("(")[0].strip()[:31])
+                   for ciclo in CURSOS_VIDA if ciclo in presentes}
+
+    encabezado = list(df.columns)
+    for hoja in [hoja_todos, *hojas_ciclo.values()]:
+        hoja.append(encabezado)
+
+    # Cada fila va a TODOS_LOS_DATOS y a la hoja de su curso de vida
+    pos_ciclo = encabezado.index("ciclo_vital")
+    for inicio in range(0, len(df), FILAS_POR_BLOQUE_XLSX):
+        bloque = df.iloc[inicio:inicio + FILAS_POR_BLOQUE_XLSX].astype(object)
+        bloque = bloque.where(bloque.notna(), None)
+        for fila in bloque.itertuples(index=False, name=None):
+            hoja_todos.append(fila)
+            hoja_ciclo = hojas_ciclo.get(fila[pos_ciclo])
+            if hoja_ciclo is not None:
+                hoja_ciclo.append(fila)
+
+    with tempfile.TemporaryFile() as archivo:
+        libro.save(archivo)
+        archivo.seek(0)
+        return archivo.read()
+
+
+def esquema_arrow():
+    """Esquema Arrow de DATOS derivado de ESQUEMA_DATOS (el mismo tipado de la caché)."""
+    tipos = {
+        "categoria": pa.dictionary(pa.int32(), pa.string()),
+        "fecha": pa.timestamp("us"),
+        "fecha_hora": pa.timestamp("us"),
+        "entero": pa.int32(),
+        "texto": pa.string(),
+    }
+    return pa.schema([(col, tipos[ESQUEMA_DATOS[col]]) for col in COLUMNAS_DATOS])
+
+
+def _tabla_arrow(df):
+    """Tabla Arrow de los registros con el esquema fijo de DATOS."""
+    return pa.Table.from_pandas(df[COLUMNAS_DATOS], schema=esquema_arrow(), preserve_index=False)
+
+
+def generar_parquet(df):
+    """Parquet comprimido (zstd) con codificación de diccionario y los tipos de DATOS."""
+    buffer = pa.BufferOutputStream()
+    pq.write_table(_tabla_arrow(df), buffer, compression="zstd", use_dictionary=True)
+    return buffer.getvalue().to_pybytes()
+
+
+def generar_arrow(df):
+    """Instantánea Arrow IPC (formato archivo, comprimida con zstd) con los tipos de DATOS."""
+    tabla = _tabla_arrow(df)
+    buffer = pa.BufferOutputStream()
+    opciones = pa.ipc.IpcWriteOptions(compression="zstd")
+    with pa.ipc.new_file(buffer, tabla.schema, options=opciones) as escritor:
+        escritor.write_table(tabla)
+    return buffer.getvalue().to_pybytes()
+
+
+# ============================================================
+# INSTANTÁNEAS NOCTURNAS DE EXPORTACIÓN
+# ============================================================
+
+HORA_INSTANTANEAS = 2            # hora local de la generación nocturna
+REINTENTO_INSTANTANEAS = 15 * 60  # segundos de espera si la generación falla
+INSTANTANEAS_CONSERVADAS = 7
+GENERADORES_INSTANTANEA = {
+    "csv": generar_csv,
+    "xlsx": generar_xlsx,
+    "parquet": generar_parquet,
+}
+MIME_INSTANTANEA = {
+    "csv": "text/csv",
+    "xlsx": "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+    "parquet": "application/vnd.apache.parquet",
+}
+
+
+def ruta_instantaneas(almacen):
+    """Carpeta de las instantáneas del almacén (st.secrets["instantaneas_ruta"] o ./instantaneas)."""
+    base = _secreto("instantaneas_ruta", "instantaneas")
+    return os.path.join(base, hashlib.sha1(str(almacen.clave).encode()).hexdigest()[:12])
+
+
+def leer_manifiesto(ruta):
+    """Manifiesto de la última instantánea generada (None si aún no hay)."""
+    try:
+        with open(os.path.join(ruta, "manifiesto.json"), encoding="utf-8") as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+def _nombre_eps(eps):
+    """
+    Nombre de archivo de una EPS: texto sin tildes ni espacios más un sha1 corto
+    del valor original, para que dos valores parecidos ("Nueva EPS", "NUEVA-EPS")
+    no compartan archivo.
+    """
+    texto = "_".join(normalizar_texto(eps).lower().split()) or "sin_nombre"
+    return f"eps_{texto}_{hashlib.sha1(eps.encode()).hexdigest()[:8]}"
+
+
+def _escribir_atomico(ruta, datos):
+    """Escribe un archivo completo o no lo toca (temporal + os.replace)."""
+    temporal = f"{ruta}.tmp"
+    with open(temporal, "wb") as f:
+        f.write(datos)
+    os.replace(temporal, ruta)
+
+
+def generar_instantaneas(almacen, ruta):
+    """
+    Genera CSV, Excel y Parquet del departamento y de cada EPS (los mismos
+    registros que ve un usuario de esa EPS, ver filtros_de_rol) en una carpeta
+    nueva y publica el manifiesto. Retorna el manifiesto, o None si no hay datos.
+    Los errores del almacén se propagan (cargar_datos los muestra y retorna vacío).
+    """
+    cache = _cache_datos_global()
+    with _lock_carga(cache, almacen.clave):
+        entrada = _estado_completo(almacen)
+        with cache["lock"]:
+            cache["entradas"][almacen.clave] = entrada
+    df = entrada["df"]
+    if df.empty:
+        return None
+    motor = motor_filtros(almacen, df)
+    generado = datetime.now()
+    carpeta = generado.strftime("%Y%m%d-%H%M%S")
+    destino = os.path.join(ruta, carpeta)
+    temporal = os.path.join(ruta, f".{carpeta}.tmp")
+    os.makedirs(temporal, exist_ok=True)
+
+    def escribir_alcance(nombre, datos):
+        archivos = {}
+        for formato, generar in GENERADORES_INSTANTANEA.items():
+            contenido = generar(datos)
+            archivo = f"sivigila_356_{nombre}.{formato}"
+            with open(os.path.join(temporal, archivo), "wb") as f:
+                f.write(contenido)
+            archivos[formato] = {"archivo": f"{carpeta}/{archivo}", "bytes": len(contenido),
+                                 "sha256": hashlib.sha256(contenido).hexdigest()}
+        return {"registros": len(datos), "archivos": archivos}
+
+    # El departamento va en su propia clave: ningún valor de EPS puede reemplazarlo
+    manifiesto = {"generado": generado.isoformat(timespec="seconds"), "carpeta": carpeta,
+                  "registros": len(df), "departamento": escribir_alcance("departamento", df),
+                  "eps": {}}
+    for eps in sorted(df["eps_reporta"].astype(str).unique()):
+        if eps:
+            manifiesto["eps"][eps] = escribir_alcance(
+                _nombre_eps(eps), filtrar_registros(motor, {"eps_reporta": [eps]}))
+
+    os.replace(temporal, destino)
+    _escribir_atomico(os.path.join(ruta, "manifiesto.json"),
+                      json.dumps(manifiesto, ensure_ascii=False, indent=2).encode("utf-8"))
+
+    # Conservar solo las últimas carpetas (las temporales huérfanas también se borran)
+    carpetas = sorted(c for c in os.listdir(ruta) if os.path.isdir(os.path.join(ruta, c)))
+    viejas = [c for c in carpetas if c.startswith(".") and c != f".{carpeta}.tmp"]
+    viejas += [c for c in carpetas if not c.startswith(".")][:-INSTANTANEAS_CONSERVADAS]
+    for vieja in viejas:
+        shutil.rmtree(os.path.join(ruta, vieja), ignore_errors=True)
+    return manifiesto
+
+
+def _ultima_programada(ahora):
+    """Última hora de generación programada no posterior a `ahora`."""
+    programada = ahora.replace(hour=HORA_INSTANTANEAS, minute=0, second=0, microsecond=0)
+    return programada if programada <= ahora else programada - timedelta(days=1)
+
+
+def _ciclo_instantaneas(almacen, ruta):
+    """
+    Hilo del programador: genera la instantánea si la última es anterior a la
+    hora programada (también al arrancar el proceso) y duerme hasta la siguiente.
+    """
+    while True:
+        espera = None
+        manifiesto = leer_manifiesto(ruta)
+        if (manifiesto is None
+                or datetime.fromisoformat(manifiesto["generado"]) < _ultima_programada(datetime.now())):
+            try:
+                generada = generar_instantaneas(almacen, ruta) is not None
+            except Exception as e:
+                reconectar_si_corresponde(e)
+                generada = False
+            if not generada:
+                espera = REINTENTO_INSTANTANEAS
+        if espera is None:
+            siguiente = _ultima_programada(datetime.now()) + timedelta(days=1)
+            espera = max((siguiente - datetime.now()).total_seconds(), 1)
+        time.sleep(espera)
+
+
+@st.cache_resource(show_spinner=False)
+def _programador_instantaneas():
+    """Hilos de generación nocturna por almacén (uno por proceso)."""
+    return {"lock": threading.Lock(), "hilos": {}}
+
+
+def iniciar_instantaneas(almacen):
+    """Arranca el programador de instantáneas del almacén si aún no está corriendo."""
+    programador = _programador_instantaneas()
+    with programador["lock"]:
+        if almacen.clave in programador["hilos"]:
+            return
+        ruta = ruta_instantaneas(almacen)
+        os.makedirs(ruta, exist_ok=True)
+        hilo = threading.Thread(target=_ciclo_instantaneas, args=(almacen, ruta), daemon=True)
+        programador["hilos"][almacen.clave] = hilo
+    hilo.start()
+
+
+def _alcance_de_rol(manifiesto):
+    """Alcance del manifiesto que corresponde al usuario logueado (ver filtros_de_rol)."""
+    eps = filtros_de_rol().get("eps_reporta")
+    return manifiesto.get("eps", {}).get(eps[0]) if eps else manifiesto.get("departamento")
+
+
+def _leer_instantanea(ruta, archivo):
+    with open(os.path.join(ruta, archivo), "rb") as f:
+        return f.read()
+
+
+def _panel_instantanea(almacen):
+    """
+    Descargas de la instantánea nocturna del alcance del usuario (sin consultar
+    el almacén). Retorna True si hay una instantánea disponible.
+    """
+    ruta = ruta_instantaneas(almacen)
+    manifiesto = leer_manifiesto(ruta)
+    alcance = _alcance_de_rol(manifiesto) if manifiesto else None
+    if not alcance:
+        return False
+
+    generado = datetime.fromisoformat(manifiesto["generado"])
+    st.markdown("#### 🌙 Instantánea nocturna")
+    st.caption(f"Generada el {generado.strftime('%Y-%m-%d a las %H:%M')} · "
+               f"{alcance['registros']} registros · descarga inmediata")
+    columnas = st.columns(len(alcance["archivos"]))
+    for col, (formato, info) in zip(columnas, alcance["archivos"].items()):
+        with col:
+            st.download_button(
+                label=f"⬇️ {formato.upper()} ({info['bytes'] / 1024 / 1024:.1f} MB)",
+                data=lambda archivo=info["archivo"]: _leer_instantanea(ruta, archivo),
+                file_name=os.path.basename(info["archivo"]),
+                mime=MIME_INSTANTANEA.get(formato, "application/octet-stream"),
+                on_click="ignore",
+                use_container_width=True,
+                key=f"instantanea_{formato}"
+            )
+    st.markdown("---")
+    return True
+
+
 # ============================================================
 # MÓDULO 4: EXPORTACIÓN DE DATOS
 # ============================================================
 
-def modulo_exportacion(spreadsheet):
-    """Módulo de exportación de datos a CSV y Excel."""
+def modulo_exportacion(almacen):
+    """Módulo de exportación de datos a CSV, Excel, Parquet y Arrow."""
     st.markdown(f"""
     <div class="main-header">
         <h1>📥 Exportación de Datos</h1>
-        <p>Descargue los datos registrados en formato CSV o Excel</p>
+        <p>Descargue los datos registrados en formato CSV, Excel, Parquet o Arrow</p>
     </div>
     """, unsafe_allow_html=True)
 
-    df = cargar_datos(spreadsheet, forzar=True)
-    df = filtrar_por_rol(df)
+    # La instantánea nocturna se descarga sin recargar datos; la exportación en
+    # tiempo real (recarga forzada) queda a pedido
+    if _panel_instantanea(almacen) and not st.toggle(
+            "🔄 Exportar datos en tiempo real", key="exp_en_vivo",
+            help="Recarga los datos del almacenamiento y permite filtrar antes de exportar"):
+        return
+
+    df = cargar_datos(almacen, forzar=True)
+    motor = motor_filtros(almacen, df)
+    df = filtrar_registros(motor, filtros_de_rol())
 
     if df.empty:
         st.info("📭 No hay datos disponibles para exportar.")
@@ -1426,6 +3344,15 @@ def modulo_exportacion(spreadsheet):
 
     st.markdown(f"**Total de registros disponibles para exportar: {len(df)}**")
 
+    _panel_exportacion(almacen, motor, df)
+
+
+@st.fragment
+def _panel_exportacion(almacen, motor, df):
+    """
+    Filtros, descargas y vista previa de la exportación. Cambiar un filtro solo
+    re-ejecuta este fragmento.
+    """
     # --- Filtros opcionales ---
     with st.expander("🔽 Filtrar datos antes de exportar"):
         col1, col2 = st.columns(2)
@@ -1443,15 +3370,17 @@ def modulo_exportacion(spreadsheet):
                                         options=sorted(df["estado_caso"].unique().tolist()),
                                         key="exp_estado")
 
-    df_export = df.copy()
-    if exp_eps:
-        df_export = df_export[df_export["eps_reporta"].isin(exp_eps)]
-    if exp_mun:
-        df_export = df_export[df_export["municipio_residencia"].isin(exp_mun)]
-    if exp_ciclo:
-        df_export = df_export[df_export["ciclo_vital"].isin(exp_ciclo)]
-    if exp_estado:
-        df_export = df_export[df_export["estado_caso"].isin(exp_estado)]
+    filtros_export = {
+        "eps_reporta": exp_eps,
+        "municipio_residencia": exp_mun,
+        "ciclo_vital": exp_ciclo,
+        "estado_caso": exp_estado,
+        **filtros_de_rol(),
+    }
+    df_export = filtrar_registros(motor, filtros_export)
+    # Clave de la vista (versión de datos + filtros); se calcula aquí porque los
+    # archivos se generan en otro hilo, sin acceso a la sesión
+    vista = clave_vista(almacen, motor["df"], filtros_export)
 
     st.markdown(f"**Registros a exportar (con filtros): {len(df_export)}**")
 
@@ -1459,53 +3388,68 @@ def modulo_exportacion(spreadsheet):
 
     col1, col2 = st.columns(2)
 
+    # Los archivos se generan recién al hacer clic en descargar
     with col1:
         st.markdown("#### 📄 Descargar CSV")
-        csv_data = df_export.to_csv(index=False).encode("utf-8-sig")
         st.download_button(
             label="⬇️ Descargar CSV",
-            data=csv_data,
+            data=lambda: exportacion_memorizada(vista, "csv", lambda: generar_csv(df_export)),
             file_name=f"sivigila_356_valle_{datetime.now().strftime('%Y%m%d')}.csv",
             mime="text/csv",
+            on_click="ignore",
             use_container_width=True
         )
 
     with col2:
         st.markdown("#### 📊 Descargar Excel (.xlsx)")
         st.markdown("*Con hojas separadas por curso de vida*")
-
-        buffer = io.BytesIO()
-        with pd.ExcelWriter(buffer, engine="openpyxl") as writer:
-            # Hoja con todos los datos
-            df_export.to_excel(writer, sheet_name="TODOS_LOS_DATOS", index=False)
-
-            # Hojas separadas por curso de vida
-            for ciclo in CURSOS_VIDA:
-                df_ciclo = df_export[df_export["ciclo_vital"] == ciclo]
-                if not df_ciclo.empty:
-                    nombre_hoja = ciclo.split("(")[0].strip()[:31]  # Max 31 chars para nombre de hoja
-                    df_ciclo.to_excel(writer, sheet_name=nombre_hoja, index=False)
-
-        buffer.seek(0)
         st.download_button(
             label="⬇️ Descargar Excel",
-            data=buffer,
+            data=lambda: exportacion_memorizada(vista, "xlsx", lambda: generar_xlsx(df_export)),
             file_name=f"sivigila_356_valle_{datetime.now().strftime('%Y%m%d')}.xlsx",
             mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+            on_click="ignore",
+            use_container_width=True
+        )
+
+    # Formatos columnares: conservan los tipos (fechas, enteros, categorías)
+    col1, col2 = st.columns(2)
+
+    with col1:
+        st.markdown("#### 🗃️ Descargar Parquet")
+        st.markdown("*Para análisis en pandas, R, Power BI o DuckDB*")
+        st.download_button(
+            label="⬇️ Descargar Parquet",
+            data=lambda: exportacion_memorizada(vista, "parquet", lambda: generar_parquet(df_export)),
+            file_name=f"sivigila_356_valle_{datetime.now().strftime('%Y%m%d')}.parquet",
+            mime="application/vnd.apache.parquet",
+            on_click="ignore",
+            use_container_width=True
+        )
+
+    with col2:
+        st.markdown("#### 🏹 Descargar Arrow (IPC)")
+        st.markdown("*Instantánea de carga inmediata (pyarrow / polars)*")
+        st.download_button(
+            label="⬇️ Descargar Arrow",
+            data=lambda: exportacion_memorizada(vista, "arrow", lambda: generar_arrow(df_export)),
+            file_name=f"sivigila_356_valle_{datetime.now().strftime('%Y%m%d')}.arrow",
+            mime="application/vnd.apache.arrow.file",
+            on_click="ignore",
             use_container_width=True
         )
 
     # Preview de los datos
     st.markdown("---")
     st.markdown("#### 👁️ Vista previa de los datos")
-    st.dataframe(df_export, use_container_width=True, hide_index=True)
+    tabla_paginada(df_export, COLUMNAS_DATOS, "exportacion_vista")
 
 
 # ============================================================
 # MÓDULO 5: GESTIÓN DE USUARIOS (solo SECRETARÍA)
 # ============================================================
 
-def modulo_gestion_usuarios(spreadsheet):
+def modulo_gestion_usuarios(almacen):
     """Gestión de usuarios del sistema (solo administrador)."""
     st.markdown(f"""
     <div class="main-header">
@@ -1521,8 +3465,7 @@ def modulo_gestion_usuarios(spreadsheet):
     # --- Usuarios actuales ---
     st.markdown("#### 👥 Usuarios registrados")
     try:
-        hoja_usuarios = obtener_hoja_usuarios(spreadsheet)
-        registros = hoja_usuarios.get_all_records()
+        registros = almacen.leer_usuarios()
         df_usuarios = pd.DataFrame(registros)
         if not df_usuarios.empty:
             # No mostrar el hash de la contraseña
@@ -1531,6 +3474,7 @@ def modulo_gestion_usuarios(spreadsheet):
         else:
             st.info("No hay usuarios registrados.")
     except Exception as e:
+        reconectar_si_corresponde(e)
         st.error(f"Error al cargar usuarios: {str(e)}")
 
     st.markdown("---")
@@ -1560,7 +3504,7 @@ def modulo_gestion_usuarios(spreadsheet):
                 st.error("⚠️ La contraseña debe tener al menos 6 caracteres.")
             else:
                 eps_asig = nueva_eps if nuevo_rol == "EPS" and nueva_eps != "N/A" else ""
-                exito, msg = crear_usuario(spreadsheet, nuevo_usuario, nueva_password,
+                exito, msg = crear_usuario(almacen, nuevo_usuario, nueva_password,
                                            nuevo_nombre, nuevo_rol, eps_asig)
                 if exito:
                     st.success(f"✅ {msg}")
@@ -1693,158 +3637,311 @@ def detectar_tipo_base(df):
     return "COMPLETA"
 
 
-def transformar_base(df, tipo_base):
-    """Transforma la base (Completa o SAT) al esquema de COLUMNAS_DATOS del aplicativo."""
-    registros = []
+def _entero_o_cero(val):
+    """Entero de un valor de la base SIVIGILA (admite '12:' o 12.0); 0 si no es numérico."""
+    try:
+        return int(float(str(val).replace(":", "").strip()))
+    except (ValueError, OverflowError):
+        return 0
 
-    for _, row in df.iterrows():
-        # --- EPS ---
-        if tipo_base == "COMPLETA" and "EAPB" in df.columns:
-            eps_raw = str(row.get("EAPB", "")).strip()
-        else:
-            cod = str(row.get("cod_ase_", "")).strip()
-            eps_raw = EAPB_MAP.get(cod, cod)
-        eps_final = normalizar_eps(eps_raw)
 
-        # --- Nombres y apellidos ---
-        pri_nom = str(row.get("pri_nom_", "")).strip().upper()
-        seg_nom = str(row.get("seg_nom_", "")).strip().upper()
-        nombres = f"{pri_nom} {seg_nom}".strip()
+def convertir_si_no(val, es_sat):
+    """SI/NO desde código SAT (1/2) o desde etiqueta de la Base Completa."""
+    if es_sat:
+        return LBL_SI_NO.get(_entero_o_cero(val), "NO")
+    return "SI" if str(val).strip().upper() in ["SI", "SÍ", "1"] else "NO"
 
-        pri_ape = str(row.get("pri_ape_", "")).strip().upper()
-        seg_ape = str(row.get("seg_ape_", "")).strip().upper()
-        apellidos = f"{pri_ape} {seg_ape}".strip()
 
-        # --- Edad y curso de vida ---
-        edad_raw = row.get("edad_", 0)
-        try:
-            edad = int(float(str(edad_raw).replace(":", "").strip()))
-        except:
-            edad = 0
-        curso = calcular_curso_vida(edad)
+def fmt_fecha(val):
+    """Fecha de la base SIVIGILA (día primero) como YYYY-MM-DD; "" si está vacía."""
+    if pd.isna(val) or str(val).strip() in ["", "None", "-   -", "NaT"]:
+        return ""
+    try:
+        return pd.to_datetime(val, dayfirst=True, errors="coerce").strftime("%Y-%m-%d")
+    except:
+        return str(val).strip()
 
-        # --- Sexo ---
-        sexo_raw = str(row.get("sexo_", "")).strip().upper()
-        if tipo_base == "SAT":
-            sexo = LBL_SEXO.get(sexo_raw, sexo_raw)
-        else:
-            if sexo_raw == "M":
-                sexo = "Masculino"
-            elif sexo_raw == "F":
-                sexo = "Femenino"
-            else:
-                sexo = sexo_raw if sexo_raw in ["Masculino", "Femenino", "Indeterminado"] else "Indeterminado"
 
-        # --- Intento previo ---
-        ip_raw = row.get("inten_prev", "")
-        if tipo_base == "SAT":
-            try:
-                ip_val = int(float(str(ip_raw).replace(":", "").strip()))
-                intento = LBL_SI_NO.get(ip_val, "NO")
-            except:
-                intento = "NO"
-        else:
-            intento = "SI" if str(ip_raw).strip().upper() in ["SI", "SÍ", "1"] else "NO"
+def _columna_base(df, nombre, defecto=""):
+    """Columna de la base cargada, o una constante si el archivo no la trae."""
+    if nombre in df.columns:
+        return df[nombre]
+    return pd.Series([defecto] * len(df), index=df.index, dtype=object)
 
-        # --- Hospitalización ---
-        if tipo_base == "SAT" and "pac_hos_" in df.columns:
-            try:
-                ph = int(float(str(row.get("pac_hos_", "")).replace(":", "").strip()))
-                hosp = LBL_PAC_HOS.get(ph, "NO APLICA")
-            except:
-                hosp = "NO APLICA"
-        else:
-            hosp = "NO APLICA"
 
-        # --- Valoraciones psicología/psiquiatría ---
-        def convertir_si_no(val, es_sat):
-            if es_sat:
-                try:
-                    v = int(float(str(val).replace(":", "").strip()))
-                    return LBL_SI_NO.get(v, "NO")
-                except:
-                    return "NO"
-            else:
-                return "SI" if str(val).strip().upper() in ["SI", "SÍ", "1"] else "NO"
+def _texto_base(df, nombre, defecto=""):
+    """Columna de la base como texto limpio en mayúsculas."""
+    return _columna_base(df, nombre, defecto).map(lambda v: str(v).strip().upper())
 
-        val_psic = convertir_si_no(row.get("psicologia", ""), tipo_base == "SAT")
-        val_psiq = convertir_si_no(row.get("psiquiatri", ""), tipo_base == "SAT")
 
-        # --- Municipio ---
-        mun = str(row.get("nmun_resi", "")).strip().upper()
+def _por_valor_distinto(serie, funcion):
+    """Aplica funcion una sola vez por cada valor distinto de la serie."""
+    memo = {}
 
-        # --- Fechas ---
-        def fmt_fecha(val):
-            if pd.isna(val) or str(val).strip() in ["", "None", "-   -", "NaT"]:
-                return ""
-            try:
-                return pd.to_datetime(val, dayfirst=True, errors="coerce").strftime("%Y-%m-%d")
-            except:
-                return str(val).strip()
+    def aplicar(v):
+        clave = (type(v), v)
+        if clave not in memo:
+            memo[clave] = funcion(v)
+        return memo[clave]
 
-        fec_not = fmt_fecha(row.get("fec_not", ""))
-        fec_con = fmt_fecha(row.get("fec_con_", ""))
-        fec_hos = fmt_fecha(row.get("fec_hos_", ""))
+    return serie.map(aplicar)
+
+
+def transformar_base(df, tipo_base, reservar=True):
+    """
+    Transforma la base (Completa o SAT) al esquema de COLUMNAS_DATOS del aplicativo.
+    Procesa columna por columna; las conversiones costosas (EPS, fechas) se
+    calculan una vez por valor distinto. Los IDs se reservan en un solo bloque;
+    con reservar=False quedan vacíos (para asignarlos solo a lo que se inserta).
+    """
+    es_sat = tipo_base == "SAT"
+    ahora = datetime.now()
+    marca_tiempo = ahora.strftime("%Y-%m-%d %H:%M:%S")
+
+    # --- EPS ---
+    if tipo_base == "COMPLETA" and "EAPB" in df.columns:
+        eps_raw = _columna_base(df, "EAPB").map(lambda v: str(v).strip())
+    else:
+        eps_raw = _columna_base(df, "cod_ase_").map(lambda v: EAPB_MAP.get(str(v).strip(), str(v).strip()))
+    eps_final = _por_valor_distinto(eps_raw, normalizar_eps)
+
+    # --- Nombres y apellidos ---
+    nombres = (_texto_base(df, "pri_nom_") + " " + _texto_base(df, "seg_nom_")).map(str.strip)
+    apellidos = (_texto_base(df, "pri_ape_") + " " + _texto_base(df, "seg_ape_")).map(str.strip)
+
+    # --- Edad y curso de vida ---
+    edad = _columna_base(df, "edad_", 0).map(_entero_o_cero)
+    curso = edad.map(calcular_curso_vida)
+
+    # --- Sexo ---
+    sexo_raw = _texto_base(df, "sexo_")
+    if es_sat:
+        sexo = sexo_raw.map(lambda s: LBL_SEXO.get(s, s))
+    else:
+        sexo = sexo_raw.map(lambda s: {"M": "Masculino", "F": "Femenino"}.get(
+            s, s if s in ["Masculino", "Femenino", "Indeterminado"] else "Indeterminado"))
+
+    # --- Intento previo, valoraciones y grupo poblacional ---
+    def si_no(nombre):
+        return _columna_base(df, nombre).map(lambda v: convertir_si_no(v, es_sat))
+
+    # --- Hospitalización ---
+    if es_sat and "pac_hos_" in df.columns:
+        hosp = df["pac_hos_"].map(lambda v: LBL_PAC_HOS.get(_entero_o_cero(v), "NO APLICA"))
+    else:
+        hosp = pd.Series("NO APLICA", index=df.index)
+
+    # --- Fechas ---
+    fec_not = _por_valor_distinto(_columna_base(df, "fec_not"), fmt_fecha)
+    fec_con = _por_valor_distinto(_columna_base(df, "fec_con_"), fmt_fecha)
+    fec_hos = _por_valor_distinto(_columna_base(df, "fec_hos_"), fmt_fecha)
+
+    # --- Semana ---
+    semana = _columna_base(df, "semana", 0).map(_entero_o_cero)
+
+    # --- Número de documento ---
+    num_doc = _columna_base(df, "num_ide_").map(lambda v: str(v).strip().replace(".0", "").split(".")[0])
+
+    transformado = pd.DataFrame({
+        "id": reservar_ids(len(df)) if reservar else "",
+        "fecha_digitacion": marca_tiempo,
+        "funcionario_reporta": "CARGA MASIVA",
+        "eps_reporta": eps_final,
+        "semana_epidemiologica": semana.map(str),
+        "ciclo_vital": curso,
+        "intento_previo": si_no("inten_prev"),
+        "nombres": nombres,
+        "apellidos": apellidos,
+        "tipo_documento": _texto_base(df, "tip_ide_", "CC"),
+        "numero_documento": num_doc,
+        "edad": edad.map(str),
+        "sexo": sexo,
+        "municipio_residencia": _texto_base(df, "nmun_resi"),
+        "fecha_notificacion_sivigila": fec_not,
+        "fecha_atencion_medicina": fec_con,
+        "hospitalizacion": hosp,
+        "fecha_alta": fec_hos.where(hosp == "SI", ""),
+        "valoracion_psicologia": si_no("psicologia"),
+        "fecha_psicologia": "",
+        "valoracion_psiquiatria": si_no("psiquiatri"),
+        "fecha_psiquiatria": "",
+        "seguimiento_1": "", "seguimiento_2": "", "seguimiento_3": "",
+        "ruta_salud_mental": "EN PROCESO",
+        "asiste_servicios": "SIN CONTACTO",
+        "seguimiento_7dias_postalta": "NO APLICA",
+        "fecha_seguimiento_postalta": "",
+        "num_seguimientos_realizados": "0",
+        "abandono_tratamiento": "SIN INFORMACIÓN",
+        "reintento_posterior": "SIN INFORMACIÓN",
+        "estado_caso": "ACTIVO",
+        "observaciones": f"Carga masiva ({tipo_base}) - {ahora.strftime('%Y-%m-%d')}",
+        "gp_discapacidad": si_no("gp_discapa"),
+        "gp_desplazado": si_no("gp_desplaz"),
+        "gp_migrante": si_no("gp_migrant"),
+        "gp_gestante": si_no("gp_gestan"),
+        "gp_desmovilizado": si_no("gp_desmovi"),
+        "gp_indigena": si_no("gp_indige"),
+        "ultima_modificacion_por": st.session_state.get("nombre_completo", ""),
+        "ultima_modificacion_fecha": marca_tiempo,
+    }, index=df.index, columns=COLUMNAS_DATOS)
+    return transformado.reset_index(drop=True)
+
+
+# ============================================================
+# INGESTA POR BLOQUES DE LA CARGA MASIVA
+# ============================================================
+# El archivo se recorre dos veces, bloque a bloque y sin armarlo completo en
+# memoria: una para el resumen (duplicados, vista previa) y otra, al confirmar,
+# para transformar, depurar e insertar cada bloque.
+
+FILAS_POR_BLOQUE_CARGA = 5000
+TAMANO_LOTE_CARGA = 500  # filas por llamada a agregar_filas
+MAX_VISTA_PREVIA_CARGA = 1000
+COLUMNAS_VISTA_PREVIA_CARGA = ["nombres", "apellidos", "numero_documento", "eps_reporta",
+                               "municipio_residencia", "edad", "sexo", "intento_previo",
+                               "fecha_notificacion_sivigila"]
 
-        # --- Semana ---
-        try:
-            semana = int(float(str(row.get("semana", 0)).replace(":", "").strip()))
-        except:
-            semana = 0
-
-        # --- Número de documento ---
-        num_doc = str(row.get("num_ide_", "")).strip().replace(".0", "").split(".")[0]
-
-        registro = {
-            "id": generar_id(),
-            "fecha_digitacion": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-            "funcionario_reporta": "CARGA MASIVA",
-            "eps_reporta": eps_final,
-            "semana_epidemiologica": str(semana),
-            "ciclo_vital": curso,
-            "intento_previo": intento,
-            "nombres": nombres,
-            "apellidos": apellidos,
-            "tipo_documento": str(row.get("tip_ide_", "CC")).strip().upper(),
-            "numero_documento": num_doc,
-            "edad": str(edad),
-            "sexo": sexo,
-            "municipio_residencia": mun,
-            "fecha_notificacion_sivigila": fec_not,
-            "fecha_atencion_medicina": fec_con,
-            "hospitalizacion": hosp,
-            "fecha_alta": fec_hos if hosp == "SI" else "",
-            "valoracion_psicologia": val_psic,
-            "fecha_psicologia": "",
-            "valoracion_psiquiatria": val_psiq,
-            "fecha_psiquiatria": "",
-            "seguimiento_1": "", "seguimiento_2": "", "seguimiento_3": "",
-            "ruta_salud_mental": "EN PROCESO",
-            "asiste_servicios": "SIN CONTACTO",
-            "seguimiento_7dias_postalta": "NO APLICA",
-            "fecha_seguimiento_postalta": "",
-            "num_seguimientos_realizados": "0",
-            "abandono_tratamiento": "SIN INFORMACIÓN",
-            "reintento_posterior": "SIN INFORMACIÓN",
-            "estado_caso": "ACTIVO",
-            "observaciones": f"Carga masiva ({tipo_base}) - {datetime.now().strftime('%Y-%m-%d')}",
-            "gp_discapacidad": convertir_si_no(row.get("gp_discapa", ""), tipo_base == "SAT"),
-            "gp_desplazado": convertir_si_no(row.get("gp_desplaz", ""), tipo_base == "SAT"),
-            "gp_migrante": convertir_si_no(row.get("gp_migrant", ""), tipo_base == "SAT"),
-            "gp_gestante": convertir_si_no(row.get("gp_gestan", ""), tipo_base == "SAT"),
-            "gp_desmovilizado": convertir_si_no(row.get("gp_desmovi", ""), tipo_base == "SAT"),
-            "gp_indigena": convertir_si_no(row.get("gp_indige", ""), tipo_base == "SAT"),
-            "ultima_modificacion_por": st.session_state.get("nombre_completo", ""),
-            "ultima_modificacion_fecha": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-        }
-        registros.append(registro)
-        # Pequeña pausa para IDs únicos
-        time.sleep(0.001)
 
-    return pd.DataFrame(registros)
+def leer_por_bloques(archivo):
+    """
+    Lee el archivo subido en bloques de FILAS_POR_BLOQUE_CARGA filas: el CSV con
+    chunksize y el .xlsx con el iterador de solo lectura de openpyxl (el .xls
+    se lee completo y se parte). Produce (bloque, avance); el avance va de 0 a
+    1, o es None si no se conoce el tamaño.
+    """
+    archivo.seek(0)
+    if archivo.name.endswith(".csv"):
+        tamano = max(archivo.getbuffer().nbytes, 1)
+        with pd.read_csv(archivo, encoding="utf-8-sig", chunksize=FILAS_POR_BLOQUE_CARGA) as lector:
+            for bloque in lector:
+                yield bloque, min(archivo.tell() / tamano, 1.0)
+        return
 
+    if archivo.name.endswith(".xls"):
+        df = pd.read_excel(archivo)
+        for inicio in range(0, len(df), FILAS_POR_BLOQUE_CARGA):
+            fin = inicio + FILAS_POR_BLOQUE_CARGA
+            yield df.iloc[inicio:fin], min(fin / len(df), 1.0)
+        return
 
-def modulo_carga_masiva(spreadsheet):
+    libro = load_workbook(archivo, read_only=True, data_only=True)
+    try:
+        hoja = libro.worksheets[0]
+        total = (hoja.max_row or 0) - 1
+        filas = hoja.iter_rows(values_only=True)
+        encabezado = [c if c is not None else f"Unnamed: {n}" for n, c in enumerate(next(filas, ()))]
+        bloque, leidas = [], 0
+        for fila in filas:
+            leidas += 1
+            if all(v is None for v in fila):
+                continue
+            bloque.append(fila[:len(encabezado)])
+            if len(bloque) == FILAS_POR_BLOQUE_CARGA:
+                yield pd.DataFrame(bloque, columns=encabezado), min(leidas / total, 1.0) if total > 0 else None
+                bloque = []
+        if bloque:
+            yield pd.DataFrame(bloque, columns=encabezado), 1.0
+    finally:
+        libro.close()
+
+
+def _llaves_carga(df):
+    """Llave de duplicados de la carga masiva: numero_documento + fecha_notificacion_sivigila."""
+    return df["numero_documento"].astype(str).str.strip() + "_" + df["fecha_notificacion_sivigila"].astype(str).str.strip()
+
+
+def nuevos_del_bloque(almacen, df_bloque, llaves_vistas):
+    """
+    Registros del bloque transformado que no existen en la base ni aparecieron
+    antes en el archivo. Agrega sus llaves a llaves_vistas.
+    """
+    df_existente = cargar_datos(almacen)
+    llaves_existentes = set()
+    if not df_existente.empty:
+        # Solo se arman las llaves de los documentos que trae el bloque (índice por documento)
+        existentes = df_existente.loc[posiciones_de_documentos(
+            almacen, df_existente, df_bloque["numero_documento"].unique())]
+        llaves_existentes = set((
+            existentes["numero_documento"].astype(str).str.strip() + "_" +
+            fechas_a_texto(existentes["fecha_notificacion_sivigila"])
+        ).tolist())
+    llaves = _llaves_carga(df_bloque)
+    mascara = ~llaves.isin(llaves_existentes) & ~llaves.isin(llaves_vistas) & ~llaves.duplicated()
+    llaves_vistas.update(llaves[mascara])
+    return df_bloque[mascara]
+
+
+def analizar_carga(almacen, archivo, progreso):
+    """
+    Primera pasada: tipo de base, conteos de registros, duplicados y nuevos, y
+    una vista previa acotada de los nuevos. El tipo se detecta en el primer bloque.
+    """
+    cargar_datos(almacen, forzar=True)
+    resumen = {"archivo": archivo.file_id, "tipo": None, "columnas": 0,
+               "total": 0, "duplicados": 0, "nuevos": 0}
+    llaves_vistas = set()
+    vista_previa = []
+    for numero, (bloque, avance) in enumerate(leer_por_bloques(archivo), start=1):
+        if resumen["tipo"] is None:
+            resumen["tipo"], resumen["columnas"] = detectar_tipo_base(bloque), len(bloque.columns)
+        nuevos = nuevos_del_bloque(almacen, transformar_base(bloque, resumen["tipo"], reservar=False),
+                                   llaves_vistas)
+        resumen["total"] += len(bloque)
+        resumen["nuevos"] += len(nuevos)
+        resumen["duplicados"] += len(bloque) - len(nuevos)
+        faltan = MAX_VISTA_PREVIA_CARGA - sum(len(v) for v in vista_previa)
+        if faltan > 0 and not nuevos.empty:
+            vista_previa.append(nuevos[COLUMNAS_VISTA_PREVIA_CARGA].head(faltan))
+        if avance is not None:
+            progreso.progress(avance, text=f"Analizando bloque {numero}... ({resumen['total']} registros)")
+    resumen["vista_previa"] = (pd.concat(vista_previa, ignore_index=True) if vista_previa
+                               else pd.DataFrame(columns=COLUMNAS_VISTA_PREVIA_CARGA))
+    return resumen
+
+
+def insertar_carga(almacen, archivo, tipo, progreso, estado, conteo):
+    """
+    Segunda pasada: transforma, depura e inserta cada bloque del archivo.
+    Los totales se llevan en `conteo` ({"insertados": n, "errores": n}) a medida
+    que avanza, así se conocen aunque la carga se interrumpa con un error.
+    """
+    cargar_datos(almacen, forzar=True)
+    llaves_vistas = set()
+    for numero, (bloque, avance) in enumerate(leer_por_bloques(archivo), start=1):
+        nuevos = nuevos_del_bloque(almacen, transformar_base(bloque, tipo, reservar=False), llaves_vistas)
+        # IDs solo para los registros que se van a insertar
+        nuevos = nuevos.assign(id=reservar_ids(len(nuevos)))
+        filas = [fila_para_hoja(row) for _, row in nuevos.iterrows()]
+
+        # El planificador regula el ritmo según la cuota de la API y reintenta
+        # los errores de cuota, sin frenar a los usuarios interactivos
+        escritas, posiciones_escritas = [], []
+        try:
+            for i in range(0, len(filas), TAMANO_LOTE_CARGA):
+                lote = filas[i:i + TAMANO_LOTE_CARGA]
+                try:
+                    posiciones = almacen.agregar_filas(lote, prioridad="masiva")
+                    conteo["insertados"] += len(lote)
+                    escritas.extend(lote)
+                    posiciones_escritas = (None if posiciones is None or posiciones_escritas is None
+                                           else posiciones_escritas + list(posiciones))
+                except Exception as e:
+                    conteo["errores"] += len(lote)
+                    st.warning(f"Error en el bloque {numero}, lote {i // TAMANO_LOTE_CARGA + 1}: {e}")
+
+                cola = estado_planificador()["escritura"]
+                estado.text(f"Bloque {numero}: insertados {conteo['insertados']} registros... "
+                            f"(escrituras en espera: {cola['interactiva'] + cola['masiva']})")
+        finally:
+            # Write-through una vez por bloque (cada fusión copia la instantánea);
+            # se reconcilia una sola vez al final
+            if escritas:
+                escribir_en_cache(almacen, escritas, posiciones_escritas, reconciliar=False)
+        if avance is not None:
+            progreso.progress(avance)
+
+
+def modulo_carga_masiva(almacen):
     """Módulo para carga masiva de bases SIVIGILA (Completa o SAT)."""
     st.markdown("""
     <div class="main-header">
@@ -1861,7 +3958,8 @@ def modulo_carga_masiva(spreadsheet):
     **Instrucciones:**
     - Suba un archivo Excel (.xlsx/.xls) o CSV con la base de datos del SIVIGILA Evento 356.
     - El sistema detecta automáticamente si es **Base Completa** (con etiquetas y columna EAPB) o **Base SAT** (códigos numéricos).
-    - Se verifican duplicados contra los registros existentes usando **número de documento + fecha de notificación**.
+    - Se verifican duplicados contra los registros existentes usando **número de documento + fecha de notificación** (también dentro del mismo archivo).
+    - Los archivos grandes se procesan por bloques, con avance por bloque.
     - Solo se insertan los registros nuevos.
     """)
 
@@ -1871,131 +3969,78 @@ def modulo_carga_masiva(spreadsheet):
     if archivo is None:
         return
 
-    # --- Leer archivo ---
-    try:
-        if archivo.name.endswith(".csv"):
-            df_raw = pd.read_csv(archivo, encoding="utf-8-sig")
-        else:
-            df_raw = pd.read_excel(archivo)
-        st.success(f"✅ Archivo leído: **{len(df_raw)}** registros, **{len(df_raw.columns)}** columnas.")
-    except Exception as e:
-        st.error(f"❌ Error al leer el archivo: {e}")
-        return
+    # --- Analizar el archivo por bloques (una vez por archivo subido) ---
+    resumen = st.session_state.get("carga_masiva_resumen")
+    if not resumen or resumen["archivo"] != archivo.file_id:
+        progreso = st.progress(0.0, text="Analizando el archivo...")
+        try:
+            resumen = analizar_carga(almacen, archivo, progreso)
+        except Exception as e:
+            progreso.empty()
+            st.error(f"❌ Error al leer el archivo: {e}")
+            return
+        progreso.empty()
+        st.session_state["carga_masiva_resumen"] = resumen
 
-    # --- Detectar tipo ---
-    tipo = detectar_tipo_base(df_raw)
-    st.info(f"📋 Tipo de base detectado: **{tipo}**")
+    st.success(f"✅ Archivo leído: **{resumen['total']}** registros, **{resumen['columnas']}** columnas.")
 
-    if df_raw.empty:
+    if resumen["total"] == 0:
         st.warning("No hay registros para procesar.")
         return
 
-    # --- Transformar ---
-    with st.spinner("Transformando datos al esquema del aplicativo..."):
-        df_transformado = transformar_base(df_raw, tipo)
-
-    st.success(f"✅ **{len(df_transformado)}** registros transformados.")
-
-    # --- Cargar datos existentes y detectar duplicados ---
-    with st.spinner("Verificando duplicados contra la base existente..."):
-        df_existente = cargar_datos(spreadsheet, forzar=True)
-
-    if not df_existente.empty:
-        # Llave: numero_documento + fecha_notificacion_sivigila
-        df_existente["_llave_dup"] = (
-            df_existente["numero_documento"].astype(str).str.strip() + "_" +
-            df_existente["fecha_notificacion_sivigila"].astype(str).str.strip()
-        )
-        df_transformado["_llave_dup"] = (
-            df_transformado["numero_documento"].astype(str).str.strip() + "_" +
-            df_transformado["fecha_notificacion_sivigila"].astype(str).str.strip()
-        )
-
-        llaves_existentes = set(df_existente["_llave_dup"].tolist())
-        mascara_nuevos = ~df_transformado["_llave_dup"].isin(llaves_existentes)
-
-        n_duplicados = (~mascara_nuevos).sum()
-        df_nuevos = df_transformado[mascara_nuevos].drop(columns=["_llave_dup"])
-    else:
-        n_duplicados = 0
-        df_nuevos = df_transformado.drop(columns=["_llave_dup"], errors="ignore")
+    st.info(f"📋 Tipo de base detectado: **{resumen['tipo']}**")
 
     # --- Resumen ---
     st.markdown("---")
     st.markdown("### 📊 Resumen de la carga")
     col1, col2, col3 = st.columns(3)
     with col1:
-        st.metric("Registros en el archivo", len(df_raw))
+        st.metric("Registros en el archivo", resumen["total"])
     with col2:
-        st.metric("Duplicados descartados", n_duplicados)
+        st.metric("Duplicados descartados", resumen["duplicados"])
     with col3:
-        st.metric("Registros nuevos a insertar", len(df_nuevos))
+        st.metric("Registros nuevos a insertar", resumen["nuevos"])
 
-    if df_nuevos.empty:
+    if resumen["nuevos"] == 0:
         st.warning("⚠️ Todos los registros ya existen en la base de datos. No hay nada nuevo que insertar.")
         return
 
     # Vista previa
     with st.expander("👁️ Vista previa de registros nuevos"):
-        cols_preview = ["nombres", "apellidos", "numero_documento", "eps_reporta",
-                        "municipio_residencia", "edad", "sexo", "intento_previo",
-                        "fecha_notificacion_sivigila"]
-        cols_disp = [c for c in cols_preview if c in df_nuevos.columns]
-        st.dataframe(df_nuevos[cols_disp], use_container_width=True, hide_index=True)
+        vista_previa = resumen["vista_previa"]
+        if resumen["nuevos"] > len(vista_previa):
+            st.caption(f"Primeros {len(vista_previa)} de {resumen['nuevos']} registros nuevos.")
+        st.dataframe(vista_previa, use_container_width=True, hide_index=True)
 
     # --- Confirmación e inserción ---
     st.markdown("---")
-    confirmar = st.button(f"✅ Confirmar e insertar {len(df_nuevos)} registros",
+    confirmar = st.button(f"✅ Confirmar e insertar {resumen['nuevos']} registros",
                           type="primary", use_container_width=True)
 
     if confirmar:
-        hoja = obtener_hoja_datos(spreadsheet)
-        progreso = st.progress(0)
+        progreso = st.progress(0.0)
         estado = st.empty()
-
-        # Preparar todas las filas
-        todas_filas = []
-        for _, row in df_nuevos.iterrows():
-            fila = [str(row.get(col, "")) for col in COLUMNAS_DATOS]
-            todas_filas.append(fila)
-
-        # Insertar en lotes de 50 para no exceder cuota de API
-        TAMANO_LOTE = 50
-        errores = 0
-        insertados = 0
-
-        for i in range(0, len(todas_filas), TAMANO_LOTE):
-            lote = todas_filas[i:i + TAMANO_LOTE]
-            try:
-                hoja.append_rows(lote, value_input_option="USER_ENTERED", table_range="A1")
-                insertados += len(lote)
-            except Exception as e:
-                errores += len(lote)
-                st.warning(f"Error en lote {i//TAMANO_LOTE + 1}: {e}")
-                # Esperar más tiempo si hay error de cuota
-                time.sleep(30)
-                try:
-                    hoja.append_rows(lote, value_input_option="USER_ENTERED", table_range="A1")
-                    insertados += len(lote)
-                    errores -= len(lote)
-                except:
-                    pass
-
-            progreso.progress(min((i + len(lote)) / len(todas_filas), 1.0))
-            estado.text(f"Insertando lote {i//TAMANO_LOTE + 1} de {(len(todas_filas)-1)//TAMANO_LOTE + 1}...")
-            time.sleep(2)
-
-        progreso.empty()
-        estado.empty()
-
-        # Invalidar caché
-        if "_datos_cache_time" in st.session_state:
-            st.session_state["_datos_cache_time"] = 0
-
-        if errores == 0:
+        conteo = {"insertados": 0, "errores": 0}
+        fallo = None
+        try:
+            insertar_carga(almacen, archivo, resumen["tipo"], progreso, estado, conteo)
+        except Exception as e:
+            fallo = e
+        finally:
+            progreso.empty()
+            estado.empty()
+            # Reconciliar la caché compartida con lo que quedó en el almacén
+            reconciliar_cache_datos(almacen)
+            st.session_state.pop("carga_masiva_resumen", None)
+
+        insertados, errores = conteo["insertados"], conteo["errores"]
+        if fallo is not None:
+            st.error(f"❌ Error durante la carga: {fallo}. "
+                     f"Insertados {insertados} registros antes del error ({errores} con errores).")
+        elif insertados and errores == 0:
             st.success(f"🎉 **{insertados}** registros insertados exitosamente.")
             st.balloons()
-        else:
+        elif insertados or errores:
             st.warning(f"⚠️ Insertados {insertados} registros. {errores} con errores.")
 
 
@@ -2011,28 +4056,31 @@ def main():
         mostrar_login()
         return
 
-    # Conectar a Google Sheets
-    spreadsheet = obtener_conexion_gsheets()
-    if not spreadsheet:
-        st.error("No se pudo conectar a Google Sheets. Verifique la configuración.")
+    # Conectar al almacenamiento (Google Sheets o SQLite)
+    almacen = obtener_almacen()
+    if not almacen:
+        st.error("No se pudo conectar al almacenamiento de datos. Verifique la configuración.")
         return
 
+    # Exportaciones nocturnas en segundo plano
+    iniciar_instantaneas(almacen)
+
     # Sidebar y navegación
-    pagina = mostrar_sidebar()
+    pagina = mostrar_sidebar(almacen)
 
     # Enrutar a la página correspondiente
     if pagina == "📊 Tablero de Control":
-        modulo_dashboard(spreadsheet)
+        modulo_dashboard(almacen)
     elif pagina == "📝 Registrar Nuevo Caso":
-        modulo_formulario(spreadsheet)
+        modulo_formulario(almacen)
     elif pagina == "✏️ Editar / Actualizar Caso":
-        modulo_edicion(spreadsheet)
+        modulo_edicion(almacen)
     elif pagina == "📥 Exportar Datos":
-        modulo_exportacion(spreadsheet)
+        modulo_exportacion(almacen)
     elif pagina == "📤 Carga Masiva":
-        modulo_carga_masiva(spreadsheet)
+        modulo_carga_masiva(almacen)
     elif pagina == "⚙️ Gestionar Usuarios":
-        modulo_gestion_usuarios(spreadsheet)
+        modulo_gestion_usuarios(almacen)
 
 
 # ============================================================
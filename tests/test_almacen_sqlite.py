@@ -0,0 +1,104 @@
+"""
+Almacén SQLite: posiciones estables, migración de bases antiguas y carga
+inicial (migración desde otro almacén y primer usuario).
+"""
+
+import os
+import sqlite3
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app  # noqa: E402
+from app import (  # noqa: E402
+    COLUMNAS_DATOS, AlmacenSQLite, hash_password, migrar_a_sqlite, verificar_credenciales,
+)
+
+
+def _fila(i, fecha="2025-03-01 08:00:00"):
+    valores = dict.fromkeys(COLUMNAS_DATOS, "")
+    valores.update(id=f"CS-{i:05d}", numero_documento=str(1000 + i), ultima_modificacion_fecha=fecha)
+    return [valores[c] for c in COLUMNAS_DATOS]
+
+
+def _ejecutar(ruta, *sentencias):
+    con = sqlite3.connect(ruta)
+    with con:
+        for sentencia in sentencias:
+            con.execute(sentencia)
+    con.close()
+
+
+@pytest.fixture
+def ruta(tmp_path):
+    return str(tmp_path / "sivigila.db")
+
+
+def test_posiciones_estables_tras_borrar_y_vacuum(ruta):
+    almacen = AlmacenSQLite(ruta)
+    posiciones = almacen.agregar_filas([_fila(i) for i in range(5)])
+    _ejecutar(ruta, "DELETE FROM datos WHERE id IN ('CS-00001', 'CS-00004')")
+    con = sqlite3.connect(ruta)
+    con.execute("VACUUM")
+    con.close()
+
+    df, extra = almacen.descargar_datos()
+    assert df.index.tolist() == [posiciones[0], posiciones[2], posiciones[3]]
+    assert almacen.leer_fila("CS-00003", None)[0] == posiciones[3]
+    # La posición del último registro borrado no se reutiliza
+    assert almacen.agregar_filas([_fila(5)]) == [posiciones[4] + 1]
+
+
+def test_base_sin_columna_posicion_conserva_el_rowid(ruta):
+    columnas = ", ".join(f'"{c}" TEXT NOT NULL DEFAULT \'\'' for c in COLUMNAS_DATOS)
+    _ejecutar(ruta, f"CREATE TABLE datos ({columnas})")
+    con = sqlite3.connect(ruta)
+    with con:
+        con.executemany(f"INSERT INTO datos VALUES ({', '.join('?' * len(COLUMNAS_DATOS))})",
+                        [_fila(i) for i in range(4)])
+        con.execute("DELETE FROM datos WHERE id = 'CS-00001'")
+    con.close()
+
+    df, _ = AlmacenSQLite(ruta).descargar_datos()
+    assert dict(zip(df.index, df["id"])) == {1: "CS-00000", 3: "CS-00002", 4: "CS-00003"}
+
+
+def test_escritura_condicional(ruta):
+    almacen = AlmacenSQLite(ruta)
+    posicion = almacen.agregar_filas([_fila(0)])[0]
+    cambios = {"municipio_residencia": "CALI", "ultima_modificacion_fecha": "2025-03-02 10:00:00"}
+    assert almacen.escribir_celdas(posicion, cambios, "2025-03-01 08:00:00")
+    # La versión leída ya no coincide: otro usuario guardó antes
+    assert not almacen.escribir_celdas(posicion, {"municipio_residencia": "BUGA"}, "2025-03-01 08:00:00")
+    assert almacen.leer_fila("CS-00000", posicion)[1][COLUMNAS_DATOS.index("municipio_residencia")] == "CALI"
+
+
+def test_migracion_desde_otro_almacen(tmp_path, ruta):
+    origen = AlmacenSQLite(str(tmp_path / "origen.db"))
+    origen.agregar_filas([_fila(i) for i in range(30)])
+    origen.agregar_usuario(["ana", hash_password("clave"), "Ana", "EPS", "SURA"])
+
+    destino = AlmacenSQLite(ruta)
+    assert destino.vacio()
+    assert migrar_a_sqlite(origen, destino) == (30, 1)
+    df_origen, _ = origen.descargar_datos()
+    df_destino, _ = destino.descargar_datos()
+    assert df_destino["id"].tolist() == df_origen["id"].tolist()
+    assert verificar_credenciales(destino, "ana", "clave")[0]
+
+    with pytest.raises(ValueError):
+        migrar_a_sqlite(origen, destino)
+    assert len(destino.descargar_datos()[0]) == 30
+
+
+def test_primer_usuario_desde_secretos(ruta, monkeypatch):
+    secretos = {"admin_inicial": {"usuario": "admin", "password_hash": hash_password("clave"),
+                                  "nombre_completo": "Administración"}}
+    monkeypatch.setattr(app, "_secreto", lambda clave, defecto=None: secretos.get(clave, defecto))
+    app._inicializar_sqlite.clear()
+    app._inicializar_sqlite(ruta)
+
+    valido, usuario = verificar_credenciales(AlmacenSQLite(ruta), "admin", "clave")
+    assert valido and usuario["rol"] == "SECRETARIA"
@@ -0,0 +1,63 @@
+"""
+Cubo de agregados del tablero: un rango de fechas arbitrario da los mismos
+totales que filtrar los registros, aunque el cubo agrupe por semana.
+"""
+
+import os
+import sys
+from datetime import date, timedelta
+
+import numpy as np
+import pandas as pd
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app import (  # noqa: E402
+    COLUMNAS_DATOS, MEDIDAS_CUBO, _cubo_de, _nuevo_motor, cubo_del_rango, filtrar_cubo, tipar_datos,
+)
+
+INICIO = date(2024, 1, 1)
+
+
+@pytest.fixture(scope="module")
+def df():
+    rng = np.random.default_rng(7)
+    n = 3000
+    filas = pd.DataFrame("", index=range(n), columns=COLUMNAS_DATOS)
+    filas["id"] = [f"CS-{i:05d}" for i in range(n)]
+    filas["eps_reporta"] = rng.choice(["SURA", "NUEVA EPS", "EMSSANAR"], n)
+    filas["estado_caso"] = rng.choice(["ACTIVO", "CERRADO"], n)
+    filas["intento_previo"] = rng.choice(["SI", "NO"], n)
+    filas["edad"] = rng.integers(8, 80, n).astype(str)
+    dias = rng.integers(0, 400, n)
+    filas["fecha_notificacion_sivigila"] = [(INICIO + timedelta(days=int(d))).isoformat() for d in dias]
+    filas.loc[rng.choice(n, 40, replace=False), "fecha_notificacion_sivigila"] = ""
+    return tipar_datos(filas)
+
+
+def test_cubo_agrupa_por_semana(df):
+    cubo = _cubo_de(df)
+    semanas = cubo["semana_notificacion"].dropna()
+    assert (semanas.dt.dayofweek == 6).all()  # domingo
+    assert semanas.nunique() <= 400 // 7 + 2
+
+
+@pytest.mark.parametrize("desde,hasta", [(0, 399), (3, 4), (5, 17), (6, 6), (10, 200), (-30, 40), (380, 500)])
+def test_rango_de_fechas_exacto(df, desde, hasta):
+    cubo = _cubo_de(df)
+    motor = _nuevo_motor(df)
+    rango = (INICIO + timedelta(days=desde), INICIO + timedelta(days=hasta))
+    fechas = df["fecha_notificacion_sivigila"]
+    esperado = _cubo_de(df[(fechas >= pd.Timestamp(rango[0])) & (fechas <= pd.Timestamp(rango[1]))])
+
+    obtenido = cubo_del_rango(cubo, motor, rango)
+    assert obtenido[MEDIDAS_CUBO].sum().to_dict() == esperado[MEDIDAS_CUBO].sum().to_dict()
+    filtros = {"eps_reporta": ["SURA"], "estado_caso": ["ACTIVO"]}
+    assert (filtrar_cubo(obtenido, filtros)[MEDIDAS_CUBO].sum().to_dict()
+            == filtrar_cubo(esperado, filtros)[MEDIDAS_CUBO].sum().to_dict())
+
+
+def test_sin_rango_es_el_cubo(df):
+    cubo = _cubo_de(df)
+    assert cubo_del_rango(cubo, _nuevo_motor(df), None) is cubo
@@ -0,0 +1,120 @@
+"""
+Sincronización incremental de la instantánea compartida contra el almacén
+SQLite (sin red).
+"""
+
+import os
+import sqlite3
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app  # noqa: E402
+from app import COLUMNAS_DATOS, AlmacenSQLite, cargar_datos, escribir_en_cache  # noqa: E402
+
+FECHA = "2025-03-01 08:00:00"
+
+
+def _fila(i, fecha=FECHA, **campos):
+    valores = dict.fromkeys(COLUMNAS_DATOS, "")
+    valores.update(id=f"CS-{i:05d}", numero_documento=str(1000 + i), ultima_modificacion_fecha=fecha)
+    valores.update(campos)
+    return [valores[c] for c in COLUMNAS_DATOS]
+
+
+@pytest.fixture
+def almacen(tmp_path, monkeypatch):
+    app._cache_datos_global.clear()
+    almacen = AlmacenSQLite(str(tmp_path / "sivigila.db"))
+    # Carga masiva: todas las filas comparten la fecha de modificación
+    almacen.agregar_filas([_fila(i) for i in range(50)])
+    cargar_datos(almacen)
+
+    leidas = []
+    consultar = AlmacenSQLite._consultar_datos
+
+    def espia(self, con, condicion="", parametros=()):
+        df = consultar(self, con, condicion, parametros)
+        leidas.append(len(df))
+        return df
+
+    monkeypatch.setattr(AlmacenSQLite, "_consultar_datos", espia)
+    almacen.leidas = leidas
+    yield almacen
+    app._cache_datos_global.clear()
+
+
+def _entrada(almacen):
+    return app._cache_datos_global()["entradas"][almacen.clave]
+
+
+def test_sincronizaciones_seguidas_no_releen_la_carga(almacen):
+    version = _entrada(almacen)["version"]
+    for _ in range(2):
+        df = cargar_datos(almacen, forzar=True)
+        assert len(df) == 50
+        assert sum(almacen.leidas) == 0
+    assert _entrada(almacen)["version"] == version
+
+
+def test_escritura_local_no_se_relee(almacen):
+    filas = [_fila(50, fecha="2025-03-01 09:00:00")]
+    posiciones = almacen.agregar_filas(filas)
+    escribir_en_cache(almacen, filas, posiciones, reconciliar=False)
+    version = _entrada(almacen)["version"]
+
+    for _ in range(2):
+        assert len(cargar_datos(almacen, forzar=True)) == 51
+    assert sum(almacen.leidas) == 0
+    assert _entrada(almacen)["version"] == version
+    assert str(_entrada(almacen)["marca_agua"]) == "2025-03-01 09:00:00"
+
+
+def _editar(almacen, id_registro, municipio, fecha):
+    """Edición hecha por otro proceso, sin pasar por esta caché."""
+    con = sqlite3.connect(almacen.ruta)
+    with con:
+        con.execute("UPDATE datos SET municipio_residencia = ?, ultima_modificacion_fecha = ? "
+                    "WHERE id = ?", (municipio, fecha, id_registro))
+    con.close()
+
+
+def test_edicion_en_el_segundo_de_la_marca(almacen):
+    _editar(almacen, "CS-00008", "PALMIRA", "2025-03-01 08:00:05")
+    df = cargar_datos(almacen, forzar=True)
+    assert df.loc[df["id"] == "CS-00008", "municipio_residencia"].iloc[0] == "PALMIRA"
+    assert sum(almacen.leidas) == 1
+
+    # Otra fila editada en el mismo segundo que la nueva marca de agua
+    _editar(almacen, "CS-00009", "BUGA", "2025-03-01 08:00:05")
+    almacen.leidas.clear()
+    df = cargar_datos(almacen, forzar=True)
+    assert df.loc[df["id"] == "CS-00009", "municipio_residencia"].iloc[0] == "BUGA"
+    assert sum(almacen.leidas) == 1
+
+    almacen.leidas.clear()
+    cargar_datos(almacen, forzar=True)
+    assert sum(almacen.leidas) == 0
+
+
+def test_write_through_durante_la_sincronizacion(almacen, monkeypatch):
+    # La escritura llega entre la lectura del almacén y la instalación
+    leer_cambios = AlmacenSQLite.leer_cambios
+    filas = [_fila(50, fecha="2025-03-01 09:00:00")]
+
+    def leer_y_escribir(self, entrada):
+        cambios = leer_cambios(self, entrada)
+        if not filas:
+            return cambios
+        escribir_en_cache(self, filas, self.agregar_filas(filas), reconciliar=False)
+        filas.clear()
+        return cambios
+
+    monkeypatch.setattr(AlmacenSQLite, "leer_cambios", leer_y_escribir)
+    _editar(almacen, "CS-00003", "TULUA", "2025-03-01 08:30:00")
+    df = cargar_datos(almacen, forzar=True)
+    assert "CS-00050" in set(df["id"])
+    assert df.loc[df["id"] == "CS-00003", "municipio_residencia"].iloc[0] == "TULUA"
+    assert _entrada(almacen)["df"] is df
@@ -0,0 +1,264 @@
+"""
+Regresión de transformar_base (por columnas) contra la implementación
+original fila a fila, que se conserva aquí como referencia.
+"""
+
+import os
+import sys
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app  # noqa: E402
+from app import (  # noqa: E402
+    EAPB_MAP, LBL_PAC_HOS, LBL_SEXO, LBL_SI_NO, calcular_curso_vida, normalizar_eps, st,
+    transformar_base,
+)
+
+# fmt_fecha usa dayfirst=True también con fechas ISO (igual que la versión base)
+pytestmark = pytest.mark.filterwarnings("ignore:Parsing dates:UserWarning")
+
+# Columnas que dependen del reloj o del asignador de IDs
+COLUMNAS_EXCLUIDAS = ["id", "fecha_digitacion", "ultima_modificacion_fecha"]
+
+
+def transformar_base_filas(df, tipo_base):
+    """transformar_base tal como estaba en la versión base (fila a fila), sin IDs."""
+    registros = []
+
+    for _, row in df.iterrows():
+        # --- EPS ---
+        if tipo_base == "COMPLETA" and "EAPB" in df.columns:
+            eps_raw = str(row.get("EAPB", "")).strip()
+        else:
+            cod = str(row.get("cod_ase_", "")).strip()
+            eps_raw = EAPB_MAP.get(cod, cod)
+        eps_final = normalizar_eps(eps_raw)
+
+        # --- Nombres y apellidos ---
+        pri_nom = str(row.get("pri_nom_", "")).strip().upper()
+        seg_nom = str(row.get("seg_nom_", "")).strip().upper()
+        nombres = f"{pri_nom} {seg_nom}".strip()
+
+        pri_ape = str(row.get("pri_ape_", "")).strip().upper()
+        seg_ape = str(row.get("seg_ape_", "")).strip().upper()
+        apellidos = f"{pri_ape} {seg_ape}".strip()
+
+        # --- Edad y curso de vida ---
+        edad_raw = row.get("edad_", 0)
+        try:
+            edad = int(float(str(edad_raw).replace(":", "").strip()))
+        except:
+            edad = 0
+        curso = calcular_curso_vida(edad)
+
+        # --- Sexo ---
+        sexo_raw = str(row.get("sexo_", "")).strip().upper()
+        if tipo_base == "SAT":
+            sexo = LBL_SEXO.get(sexo_raw, sexo_raw)
+        else:
+            if sexo_raw == "M":
+                sexo = "Masculino"
+            elif sexo_raw == "F":
+                sexo = "Femenino"
+            else:
+                sexo = sexo_raw if sexo_raw in ["Masculino", "Femenino", "Indeterminado"] else "Indeterminado"
+
+        # --- Intento previo ---
+        ip_raw = row.get("inten_prev", "")
+        if tipo_base == "SAT":
+            try:
+                ip_val = int(float(str(ip_raw).replace(":", "").strip()))
+                intento = LBL_SI_NO.get(ip_val, "NO")
+            except:
+                intento = "NO"
+        else:
+            intento = "SI" if str(ip_raw).strip().upper() in ["SI", "SÍ", "1"] else "NO"
+
+        # --- Hospitalización ---
+        if tipo_base == "SAT" and "pac_hos_" in df.columns:
+            try:
+                ph = int(float(str(row.get("pac_hos_", "")).replace(":", "").strip()))
+                hosp = LBL_PAC_HOS.get(ph, "NO APLICA")
+            except:
+                hosp = "NO APLICA"
+        else:
+            hosp = "NO APLICA"
+
+        # --- Valoraciones psicología/psiquiatría ---
+        def convertir_si_no(val, es_sat):
+            if es_sat:
+                try:
+                    v = int(float(str(val).replace(":", "").strip()))
+                    return LBL_SI_NO.get(v, "NO")
+                except:
+                    return "NO"
+            else:
+                return "SI" if str(val).strip().upper() in ["SI", "SÍ", "1"] else "NO"
+
+        val_psic = convertir_si_no(row.get("psicologia", ""), tipo_base == "SAT")
+        val_psiq = convertir_si_no(row.get("psiquiatri", ""), tipo_base == "SAT")
+
+        # --- Municipio ---
+        mun = str(row.get("nmun_resi", "")).strip().upper()
+
+        # --- Fechas ---
+        def fmt_fecha(val):
+            if pd.isna(val) or str(val).strip() in ["", "None", "-   -", "NaT"]:
+                return ""
+            try:
+                return pd.to_datetime(val, dayfirst=True, errors="coerce").strftime("%Y-%m-%d")
+            except:
+                return str(val).strip()
+
+        fec_not = fmt_fecha(row.get("fec_not", ""))
+        fec_con = fmt_fecha(row.get("fec_con_", ""))
+        fec_hos = fmt_fecha(row.get("fec_hos_", ""))
+
+        # --- Semana ---
+        try:
+            semana = int(float(str(row.get("semana", 0)).replace(":", "").strip()))
+        except:
+            semana = 0
+
+        # --- Número de documento ---
+        num_doc = str(row.get("num_ide_", "")).strip().replace(".0", "").split(".")[0]
+
+        registro = {
+            "id": "",
+            "fecha_digitacion": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+            "funcionario_reporta": "CARGA MASIVA",
+            "eps_reporta": eps_final,
+            "semana_epidemiologica": str(semana),
+            "ciclo_vital": curso,
+            "intento_previo": intento,
+            "nombres": nombres,
+            "apellidos": apellidos,
+            "tipo_documento": str(row.get("tip_ide_", "CC")).strip().upper(),
+            "numero_documento": num_doc,
+            "edad": str(edad),
+            "sexo": sexo,
+            "municipio_residencia": mun,
+            "fecha_notificacion_sivigila": fec_not,
+            "fecha_atencion_medicina": fec_con,
+            "hospitalizacion": hosp,
+            "fecha_alta": fec_hos if hosp == "SI" else "",
+            "valoracion_psicologia": val_psic,
+            "fecha_psicologia": "",
+            "valoracion_psiquiatria": val_psiq,
+            "fecha_psiquiatria": "",
+            "seguimiento_1": "", "seguimiento_2": "", "seguimiento_3": "",
+            "ruta_salud_mental": "EN PROCESO",
+            "asiste_servicios": "SIN CONTACTO",
+            "seguimiento_7dias_postalta": "NO APLICA",
+            "fecha_seguimiento_postalta": "",
+            "num_seguimientos_realizados": "0",
+            "abandono_tratamiento": "SIN INFORMACIÓN",
+            "reintento_posterior": "SIN INFORMACIÓN",
+            "estado_caso": "ACTIVO",
+            "observaciones": f"Carga masiva ({tipo_base}) - {datetime.now().strftime('%Y-%m-%d')}",
+            "gp_discapacidad": convertir_si_no(row.get("gp_discapa", ""), tipo_base == "SAT"),
+            "gp_desplazado": convertir_si_no(row.get("gp_desplaz", ""), tipo_base == "SAT"),
+            "gp_migrante": convertir_si_no(row.get("gp_migrant", ""), tipo_base == "SAT"),
+            "gp_gestante": convertir_si_no(row.get("gp_gestan", ""), tipo_base == "SAT"),
+            "gp_desmovilizado": convertir_si_no(row.get("gp_desmovi", ""), tipo_base == "SAT"),
+            "gp_indigena": convertir_si_no(row.get("gp_indige", ""), tipo_base == "SAT"),
+            "ultima_modificacion_por": st.session_state.get("nombre_completo", ""),
+            "ultima_modificacion_fecha": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+        }
+        registros.append(registro)
+
+    return pd.DataFrame(registros)
+
+
+def _base(n, tipo_base, semilla=0):
+    """Base SIVIGILA sintética con los casos de borde de cada columna."""
+    rng = np.random.default_rng(semilla)
+
+    def elegir(valores):
+        return pd.Series(rng.choice(np.array(valores, dtype=object), n), dtype=object)
+
+    datos = {
+        # Nombres y documentos en blanco, NaN y con espacios
+        "pri_nom_": elegir(["juan", " maría ", "josé", np.nan, "", "ñandú"]),
+        "seg_nom_": elegir(["", "luis", np.nan, "   "]),
+        "pri_ape_": elegir(["pérez", "gómez", np.nan]),
+        "seg_ape_": elegir(["x", np.nan, ""]),
+        "num_ide_": elegir([123456.0, "1000.05", " 987 ", 55, "", np.nan, "1.002.003"]),
+        "tip_ide_": elegir(["cc", "ti", " RC ", np.nan]),
+        "edad_": elegir([12, 35.0, "40:", "abc", np.nan, 70, "", 5]),
+        "nmun_resi": elegir(["cali ", "Tuluá", np.nan, ""]),
+        # Fechas con día primero, ISO, vacías, basura y Timestamp
+        "fec_not": elegir(["03/02/2025", "13/02/2025", "2025-02-13", "", "-   -", np.nan,
+                           "basura", pd.Timestamp("2025-05-06")]),
+        "fec_con_": elegir(["01/01/2025", "31/12/2024", np.nan]),
+        "fec_hos_": elegir(["05/02/2025", "", np.nan, "12/03/2025"]),
+        "semana": elegir([1, 2.0, "3", np.nan, "xx", "7:"]),
+        "gp_gestan": elegir([1, 2, "1", "SI", np.nan]),
+        "gp_desmovi": elegir([1, 2, np.nan]),
+    }
+    if tipo_base == "SAT":
+        # Códigos 1/2 como enteros, flotantes y texto; códigos de EPS conocidos y no
+        datos.update({
+            "sexo_": elegir(["M", "F", "I", "x", np.nan]),
+            "inten_prev": elegir([1, 2, 1.0, "2", "1:", np.nan, "SI"]),
+            "psicologia": elegir([1, 2, np.nan, "1"]),
+            "psiquiatri": elegir(["1", "2", 2.0, np.nan]),
+            "gp_discapa": elegir([1, 2]),
+            "gp_desplaz": elegir([1, 2, np.nan]),
+            "gp_migrant": elegir([1, "2", np.nan]),
+            "gp_indige": elegir([1, 2]),
+            "pac_hos_": elegir([1, 2, 3, 1.0, "2", np.nan, "x"]),
+            "gp_otros": 1,
+            "cod_ase_": elegir(list(EAPB_MAP)[:4] + ["XYZ999", " EPS010 ", np.nan, ""]),
+        })
+    else:
+        datos.update({
+            "sexo_": elegir(["M", "F", "Masculino", "Indeterminado", "x", np.nan]),
+            "inten_prev": elegir(["SI", "NO", "Sí", "1", 1, np.nan, "no"]),
+            "psicologia": elegir(["SI", "NO", np.nan]),
+            "psiquiatri": elegir(["SI", "1", "NO"]),
+            "gp_discapa": elegir(["SI", "NO"]),
+            "gp_desplaz": elegir(["SI", "NO", np.nan]),
+            "gp_migrant": elegir(["SI", "NO"]),
+            "gp_indige": elegir(["SI", "NO", np.nan]),
+            "EAPB": elegir(["S.O.S.", "nueva eps", "SURA", np.nan, "EPS DESCONOCIDA", " "]),
+        })
+    # Índice desordenado, como el de un archivo filtrado
+    return pd.DataFrame(datos).set_index(pd.Index(rng.permutation(n) + 100))
+
+
+def _comparables(df):
+    return df.drop(columns=COLUMNAS_EXCLUIDAS).reset_index(drop=True).astype(str)
+
+
+@pytest.mark.parametrize("tipo_base", ["COMPLETA", "SAT"])
+def test_igual_a_la_version_fila_a_fila(tipo_base):
+    df = _base(500, tipo_base)
+    esperado = transformar_base_filas(df, tipo_base)
+    obtenido = transformar_base(df, tipo_base)
+
+    assert list(obtenido.columns) == list(app.COLUMNAS_DATOS)
+    pd.testing.assert_frame_equal(_comparables(obtenido), _comparables(esperado))
+
+
+def test_sat_sin_hospitalizacion_ni_eapb():
+    # Base SAT sin pac_hos_: hospitalización NO APLICA y sin fecha de alta
+    df = _base(50, "SAT", semilla=1).drop(columns=["pac_hos_"])
+    pd.testing.assert_frame_equal(_comparables(transformar_base(df, "SAT")),
+                                  _comparables(transformar_base_filas(df, "SAT")))
+
+
+def test_completa_sin_eapb_usa_cod_ase():
+    df = _base(50, "SAT", semilla=2).drop(columns=["pac_hos_"])
+    pd.testing.assert_frame_equal(_comparables(transformar_base(df, "COMPLETA")),
+                                  _comparables(transformar_base_filas(df, "COMPLETA")))
+
+
+def test_ids_unicos():
+    df = _base(300, "COMPLETA")
+    assert transformar_base(df, "COMPLETA")["id"].is_unique